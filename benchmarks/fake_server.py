@@ -0,0 +1,225 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""In-process fake of the Billogram v2 API for benchmarking
+
+Serves the billogram, customer, item, settings and PDF endpoints from
+memory with canned data, on a background thread with its own event loop,
+so that CPU time measured on the client thread is the library's own.
+"""
+
+import asyncio
+import base64
+import json
+import threading
+
+from aiohttp import web
+
+ID_FIELDS = {
+    'billogram': 'id',
+    'customer': 'customer_no',
+    'item': 'item_no',
+}
+
+
+def make_billogram(number):
+    """A billogram object resembling the real ones in size and shape"""
+    return {
+        'id': 'BG{:08d}'.format(number),
+        'invoice_no': number,
+        'state': ('Unpaid', 'Paid', 'Credited')[number % 3],
+        'currency': 'SEK',
+        'created_at': '2020-01-01 00:00:{:08d}'.format(number),
+        'updated_at': '2020-01-02 00:00:{:08d}'.format(number),
+        'due_date': '2020-02-01',
+        'total_sum': 1250.0 + number,
+        'remaining_sum': 1250.0,
+        'customer': {
+            'customer_no': number % 500,
+            'name': 'Customer {}'.format(number % 500),
+            'address': {
+                'street_address': 'Exempelgatan {}'.format(number % 90),
+                'zipcode': '123 45',
+                'city': 'Stockholm',
+                'country': 'SE',
+            },
+        },
+        'items': [
+            {
+                'item_no': str(i),
+                'title': 'Item {}'.format(i),
+                'count': 1,
+                'price': 100.0 * i,
+                'vat': 25,
+                'unit': 'unit',
+            }
+            for i in range(1, 4)
+        ],
+        'url': 'https://billogram.com/invoice/{}'.format(number),
+    }
+
+
+def make_customer(number):
+    """A customer object"""
+    return {
+        'customer_no': number,
+        'name': 'Customer {}'.format(number),
+        'company_type': 'individual',
+        'created_at': '2020-01-01 00:00:{:08d}'.format(number),
+        'updated_at': '2020-01-01 00:00:{:08d}'.format(number),
+        'contact': {'name': 'Contact', 'email': 'c@example.com'},
+        'address': {
+            'street_address': 'Exempelgatan 1',
+            'zipcode': '123 45',
+            'city': 'Stockholm',
+            'country': 'SE',
+        },
+    }
+
+
+def make_item(number):
+    """An item object"""
+    return {
+        'item_no': str(number),
+        'title': 'Item {}'.format(number),
+        'price': 100.0,
+        'vat': 25,
+        'unit': 'unit',
+        'created_at': '2020-01-01 00:00:{:08d}'.format(number),
+        'updated_at': '2020-01-01 00:00:{:08d}'.format(number),
+    }
+
+
+class FakeBillogram:
+    """Fake API server holding 'n_objects' objects of each type
+
+    Start it with 'start' and stop it with 'stop', 'api_base' is then the
+    URL to pass to BillogramAPI.
+    """
+    def __init__(self, n_objects=1000, pdf_size=1024 * 1024):
+        self._db = {
+            'billogram': [make_billogram(i) for i in range(1, n_objects + 1)],
+            'customer': [make_customer(i) for i in range(1, n_objects + 1)],
+            'item': [make_item(i) for i in range(1, n_objects + 1)],
+        }
+        self._by_id = {
+            name: {str(o[ID_FIELDS[name]]): o for o in objects}
+            for name, objects in self._db.items()
+        }
+        pdf = (b'%PDF-1.4 fake ' * (pdf_size // 14 + 1))[:pdf_size]
+        self._pdf_body = json.dumps({
+            'status': 'OK',
+            'data': {
+                'content': base64.b64encode(pdf).decode('ascii'),
+                'content_type': 'application/pdf',
+            },
+        }).encode('utf-8')
+        self._settings_body = json.dumps({
+            'status': 'OK',
+            'data': {'name': 'Benchmark AB', 'org_no': '556000-0000'},
+        }).encode('utf-8')
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self.port = None
+
+    @property
+    def api_base(self):
+        """Base URL of the fake API"""
+        return 'http://127.0.0.1:{}/api/v2'.format(self.port)
+
+    @staticmethod
+    def _json(body, status=200):
+        return web.Response(
+            body=body, status=status, content_type='application/json')
+
+    def _ok(self, data, meta=None):
+        envelope = {'status': 'OK', 'data': data}
+        if meta is not None:
+            envelope['meta'] = meta
+        return self._json(json.dumps(envelope).encode('utf-8'))
+
+    async def _handle(self, request):
+        parts = request.match_info['path'].split('/')
+        name = parts[0]
+        if name == 'settings':
+            return self._json(self._settings_body)
+        if name not in self._db:
+            return self._json(
+                b'{"status": "NOT_FOUND", "data": {"message": "x"}}', 404)
+        if len(parts) == 1:
+            if request.method == 'POST':
+                data = await request.json()
+                return self._ok(data)
+            page_size = int(request.query.get('page_size', 100))
+            page = int(request.query.get('page', 1))
+            objects = self._db[name]
+            return self._ok(
+                objects[(page - 1) * page_size:page * page_size],
+                {'total_count': len(objects)},
+            )
+        object_id = parts[1]
+        if object_id.endswith('.pdf') or parts[2:] == ['attachment.pdf']:
+            return self._json(self._pdf_body)
+        obj = self._by_id[name].get(object_id)
+        if obj is None:
+            return self._json(
+                b'{"status": "OBJECT_NOT_FOUND", "data": {"message": "x"}}',
+                404)
+        if parts[2:3] == ['command']:
+            await request.read()
+        return self._ok(obj)
+
+    async def _start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/api/v2/{path:.*}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        # pylint: disable=protected-access
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        """Start serving on a background thread"""
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        """Stop serving and wait for the thread to end"""
+        future = asyncio.run_coroutine_threadsafe(
+            self._runner.cleanup(), self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
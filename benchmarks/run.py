@@ -0,0 +1,328 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Client overhead micro-benchmarks for the Billogram API library
+
+Runs the library against the in-process fake server and measures, per
+scenario, throughput and the CPU time spent per call on the client thread
+(the fake server runs on a thread of its own, so its work is excluded).
+
+    python benchmarks/run.py                 # run and save results
+    python benchmarks/run.py --quick         # fewer iterations
+    python benchmarks/run.py --compare benchmarks/results/abc1234.json
+
+Results are written to benchmarks/results/<commit>.json unless --output is
+given. With --compare, the relative change in CPU per call against an
+earlier results file is printed for every scenario.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from benchmarks.fake_server import FakeBillogram, make_billogram
+from billogram_api import BillogramAPI, get_codec
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+class _NullWriter:
+    """Discards everything written to it"""
+    @staticmethod
+    def write(data):
+        return len(data)
+
+
+class _StaticResponse:
+    """The parts of a response the response checks look at"""
+    ok = True
+    status = 200
+    content_type = 'application/json'
+    charset = 'utf-8'
+
+
+# runs per scenario, set from the command line
+OPTIONS = {'repeat': 3}
+
+
+async def _measure(name, params, calls, run):
+    """Time 'run', a coroutine function making 'calls' calls
+
+    The best of several runs is kept, to filter out noise from the rest of
+    the system.
+    """
+    wall = cpu = float('inf')
+    for _ in range(OPTIONS['repeat']):
+        start_cpu = time.thread_time()
+        start_wall = time.perf_counter()
+        await run()
+        wall = min(wall, time.perf_counter() - start_wall)
+        cpu = min(cpu, time.thread_time() - start_cpu)
+    result = {
+        'scenario': name,
+        'params': params,
+        'calls': calls,
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'calls_per_second': calls / wall if wall else None,
+        'cpu_us_per_call': cpu / calls * 1e6,
+    }
+    print('{:<28} {:<34} {:>10.0f}/s {:>10.1f} us cpu/call'.format(
+        name,
+        ' '.join('{}={}'.format(k, v) for k, v in params.items()),
+        result['calls_per_second'] or 0,
+        result['cpu_us_per_call'],
+    ))
+    return result
+
+
+async def bench_check_response(api, scale):
+    """Response checks and parsing of a full page, no network"""
+    results = []
+    for page_size in (10, 100):
+        body = json.dumps({
+            'status': 'OK',
+            'data': [make_billogram(i) for i in range(page_size)],
+            'meta': {'total_count': 1000},
+        }).encode('utf-8')
+        calls = 200 * scale
+        resp = _StaticResponse()
+
+        async def run(body=body, calls=calls):
+            for _ in range(calls):
+                # pylint: disable=protected-access
+                api._check_api_response(resp, body)
+        results.append(await _measure(
+            'check_api_response', {'page_size': page_size}, calls, run))
+    return results
+
+
+async def bench_codec(scale):
+    """Serializing a large billogram and parsing a full page, per JSON
+    codec installed"""
+    results = []
+    billogram = make_billogram(1)
+    billogram['items'] = billogram['items'] * 100
+    page = get_codec('json').dumps({
+        'status': 'OK',
+        'data': [make_billogram(i) for i in range(100)],
+        'meta': {'total_count': 1000},
+    })
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            codec = get_codec(name)
+        except ImportError:
+            continue
+        calls = 50 * scale
+
+        async def dumps(codec=codec, calls=calls):
+            for _ in range(calls):
+                codec.dumps(billogram)
+
+        async def loads(codec=codec, calls=calls):
+            for _ in range(calls):
+                codec.loads(page)
+        results.append(await _measure(
+            'codec_dumps', {'codec': name}, calls, dumps))
+        results.append(await _measure(
+            'codec_loads', {'codec': name}, calls, loads))
+    return results
+
+
+async def bench_fetch(api, scale):
+    """Small GET requests at several concurrency levels"""
+    results = []
+    for concurrency in (1, 10, 50):
+        calls = 100 * scale * (1 if concurrency == 1 else 4)
+
+        async def worker(n):
+            for _ in range(n):
+                await api.fetch('settings', 'GET')
+
+        async def run(concurrency=concurrency, calls=calls):
+            await asyncio.gather(*(
+                worker(calls // concurrency) for _ in range(concurrency)))
+        results.append(await _measure(
+            'fetch', {'concurrency': concurrency}, calls, run))
+    return results
+
+
+async def bench_get_page(api, scale):
+    """Fetching and wrapping one page of objects"""
+    results = []
+    for page_size in (10, 100):
+        calls = 20 * scale
+        query = api.billogram.query()
+        query.page_size = page_size
+
+        async def run(query=query, calls=calls):
+            for page in range(calls):
+                await query.get_page(page % 5 + 1)
+        results.append(await _measure(
+            'get_page', {'page_size': page_size}, calls, run))
+    return results
+
+
+async def bench_iter_all(api, scale, n_objects):
+    """Iterating over a whole collection"""
+    results = []
+    for page_size in (25, 100):
+        for prefetch in (0, 4):
+            query = api.billogram.query()
+            query.page_size = page_size
+
+            async def run(query=query, prefetch=prefetch):
+                async for _ in query.iter_all(prefetch=prefetch):
+                    pass
+            results.append(await _measure(
+                'iter_all',
+                {'page_size': page_size, 'prefetch': prefetch},
+                n_objects * max(1, scale // 5),
+                lambda run=run: asyncio.gather(
+                    *(run() for _ in range(max(1, scale // 5)))),
+            ))
+    return results
+
+
+async def bench_pdf(api, scale):
+    """Downloading and decoding invoice PDFs"""
+    billogram = api.billogram.query()
+    billogram.page_size = 1
+    billogram = (await billogram.get_page(1))[0]
+    calls = 2 * scale
+
+    async def whole():
+        for _ in range(calls):
+            await billogram.get_invoice_pdf(invoice_no=1)
+
+    async def streamed():
+        for _ in range(calls):
+            await billogram.save_invoice_pdf(_NullWriter(), invoice_no=1)
+    return [
+        await _measure('pdf_decode', {'mode': 'whole'}, calls, whole),
+        await _measure('pdf_decode', {'mode': 'streamed'}, calls, streamed),
+    ]
+
+
+async def run_all(server, scale, n_objects):
+    """Run every scenario, returns the list of results"""
+    results = []
+    async with BillogramAPI(
+            'benchmark', 'key',
+            api_base=server.api_base,
+            coalesce_gets=False,
+    ) as api:
+        results += await bench_check_response(api, scale)
+        results += await bench_codec(scale)
+        results += await bench_fetch(api, scale)
+        results += await bench_get_page(api, scale)
+        results += await bench_iter_all(api, scale, n_objects)
+        results += await bench_pdf(api, scale)
+    return results
+
+
+def git_commit():
+    """Short hash of the checked out commit, or 'unknown'"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _key(result):
+    return (result['scenario'], json.dumps(result['params'], sort_keys=True))
+
+
+def compare(results, baseline_path):
+    """Print the change in CPU per call against an earlier results file"""
+    with open(baseline_path) as fileobj:
+        baseline = {_key(r): r for r in json.load(fileobj)['results']}
+    print()
+    print('Compared to {}:'.format(baseline_path))
+    for result in results:
+        old = baseline.get(_key(result))
+        if old is None:
+            continue
+        change = result['cpu_us_per_call'] / old['cpu_us_per_call'] - 1
+        print('{:<28} {:<34} {:>+8.1%} cpu/call'.format(
+            result['scenario'],
+            ' '.join('{}={}'.format(k, v)
+                     for k, v in result['params'].items()),
+            change,
+        ))
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='run fewer iterations')
+    parser.add_argument('--objects', type=int, default=1000,
+                        help='objects of each type on the fake server')
+    parser.add_argument('--output', help='results file to write')
+    parser.add_argument('--compare', help='earlier results file')
+    parser.add_argument('--repeat', type=int, default=OPTIONS['repeat'],
+                        help='runs per scenario, the best one is kept')
+    args = parser.parse_args()
+    OPTIONS['repeat'] = max(1, args.repeat)
+
+    scale = 2 if args.quick else 10
+    server = FakeBillogram(n_objects=args.objects).start()
+    try:
+        results = asyncio.run(run_all(server, scale, args.objects))
+    finally:
+        server.stop()
+
+    commit = git_commit()
+    output = args.output or os.path.join(
+        RESULTS_DIR, '{}.json'.format(commit))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fileobj:
+        json.dump({
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'aiohttp': aiohttp.__version__,
+            'results': results,
+        }, fileobj, indent=2)
+    print('Results written to {}'.format(output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
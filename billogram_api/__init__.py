@@ -23,7 +23,34 @@
 """ Billogram Async API """
 
 from billogram_api import exceptions as ex
-from billogram_api.billogram_api import BillogramAPI
+from billogram_api.billogram_api import BillogramAPI, create_connector
+from billogram_api.bulk import BulkProgress, BulkResult
+from billogram_api.codecs import JsonCodec, get_codec
+from billogram_api.compression import CompressionStats
+from billogram_api.export import ExportReport, InvoicePdfExporter
+from billogram_api.instrumentation import (
+    HistogramCollector,
+    Instrumentation,
+    RequestRecord,
+)
+from billogram_api.mirror import LocalMirror
+from billogram_api.pool import ClientPool, TenantStats
+from billogram_api.ratelimit import RateLimiter
+from billogram_api.retry import RetryBudget, RetryPolicy
+from billogram_api.sync import SyncBillogramAPI
+from billogram_api.tracing import (
+    JsonLinesExporter,
+    Span,
+    SpanExporter,
+    Tracer,
+    current_span,
+)
+from billogram_api.transport import (
+    CassetteMissError,
+    RecordingTransport,
+    ReplayTransport,
+    SessionTransport,
+)
 
 # make an exportable namespace-class with all the exceptions
 BillogramExceptions = type(
@@ -37,6 +64,39 @@ BillogramExceptions = type(
     }
 )
 
-# just the BillogramAPI class and the exceptions are really part
-# of the call API of this module
-__all__ = ['BillogramAPI', 'BillogramExceptions']
+# just the BillogramAPI class, the client pool, the connector factory, the
+# JSON codecs, the rate limiting and retry policies, the compression stats,
+# bulk results, the PDF exporter, the local mirror, the instrumentation and
+# tracing, the transports, the synchronous facade, and the exceptions are
+# really part of the call API of this module
+__all__ = [
+    'BillogramAPI',
+    'BillogramExceptions',
+    'BulkProgress',
+    'BulkResult',
+    'CassetteMissError',
+    'ClientPool',
+    'CompressionStats',
+    'ExportReport',
+    'HistogramCollector',
+    'Instrumentation',
+    'InvoicePdfExporter',
+    'JsonCodec',
+    'JsonLinesExporter',
+    'LocalMirror',
+    'RateLimiter',
+    'RecordingTransport',
+    'ReplayTransport',
+    'RequestRecord',
+    'RetryBudget',
+    'RetryPolicy',
+    'SessionTransport',
+    'Span',
+    'SpanExporter',
+    'SyncBillogramAPI',
+    'TenantStats',
+    'Tracer',
+    'create_connector',
+    'current_span',
+    'get_codec',
+]
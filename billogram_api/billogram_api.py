@@ -22,18 +22,79 @@
 
 """Library for asynchronous accessing the Billogram v2 HTTP API"""
 
+import asyncio
 import base64
+import collections
 import copy
-import json
+import functools
 import os
+import time
 
 import aiohttp
 
 from billogram_api import exceptions as ex
+from billogram_api.bulk import BulkProgress, aiter_any, bounded_map
+from billogram_api.cache import ObjectCache
+from billogram_api.codecs import JsonCodec, get_codec
+from billogram_api.compound import BillogramCompoundQuery, CompoundQuery
+from billogram_api.compression import (
+    ACCEPT_ENCODING,
+    CompressionStats,
+    StreamDecoder,
+    compress,
+    decompress,
+)
+from billogram_api.instrumentation import (
+    Instrumentation,
+    RequestRecord,
+    url_template,
+)
+from billogram_api.ratelimit import RateLimiter
+from billogram_api.retry import RetryPolicy
+from billogram_api.streaming import (
+    CHUNK_SIZE,
+    Base64FieldExtractor,
+    iter_base64_json_body,
+    open_sink,
+)
+from billogram_api.tracing import NO_SPAN
+from billogram_api.transport import SessionTransport
 
 API_URL_BASE = 'https://billogram.com/api/v2'
 USER_AGENT = 'Billogram API Async Python Library/1.00'
 
+POOL_SIZE = 100
+POOL_SIZE_PER_HOST = 0
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+
+
+def create_connector(
+        pool_size=POOL_SIZE,
+        pool_size_per_host=POOL_SIZE_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        dns_cache_ttl=DNS_CACHE_TTL,
+):
+    """Create a connection pool for use by one or more BillogramAPI objects
+
+    'pool_size' is the maximum number of simultaneous connections and
+    'pool_size_per_host' the maximum per remote host (0 means no limit).
+    Idle connections are kept alive for 'keepalive_timeout' seconds and
+    resolved host names are cached for 'dns_cache_ttl' seconds (None caches
+    forever, 0 disables the cache).
+
+    A connector passed to several BillogramAPI objects lets them reuse each
+    others connections and TLS sessions. It is then owned by the caller and
+    must be closed by it once all the API objects are closed.
+    """
+    return aiohttp.TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size_per_host,
+        keepalive_timeout=keepalive_timeout,
+        use_dns_cache=dns_cache_ttl != 0,
+        ttl_dns_cache=dns_cache_ttl or None,
+    )
+
 
 class BillogramAPI:
     """Pseudo-connection to the Billogram v2 API
@@ -41,34 +102,238 @@ class BillogramAPI:
     Objects of this class provide a call interface to the Billogram
     v2 HTTP API.
     """
-    # pylint: disable=too-many-instance-attributes
-    def __init__(self, auth_user, auth_key, user_agent=None, api_base=None):
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(
+            self,
+            auth_user,
+            auth_key,
+            user_agent=None,
+            api_base=None,
+            json_loads=None,
+            codec='auto',
+            connector=None,
+            pool_size=POOL_SIZE,
+            pool_size_per_host=POOL_SIZE_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            dns_cache_ttl=DNS_CACHE_TTL,
+            rate_limit=None,
+            max_in_flight=None,
+            rate_limiter=None,
+            retry_policy=None,
+            coalesce_gets=True,
+            instrumentation=(),
+            tracer=None,
+            transport=None,
+            session=None,
+            compression=True,
+            compress_requests=None,
+    ):
         """Create a Billogram API connection object
 
         Pass the API authentication in the auth_user and auth_key parameters.
         API accounts can only be created from the Billogram web interface.
+
+        Request bodies are serialized and responses parsed with the JSON
+        'codec', the name of a JSON library or a JsonCodec, see the codecs
+        module. By default the fastest library installed is used. A
+        'json_loads' function can be given to parse responses with instead,
+        it is called with the raw body as bytes.
+
+        The connection pool is configured by 'pool_size',
+        'pool_size_per_host', 'keepalive_timeout' and 'dns_cache_ttl', see
+        create_connector. Alternatively an existing 'connector' can be passed
+        to share one connection pool between many API objects, the pool
+        options are then ignored and the connector is not closed by close.
+        The session and connection pool are only created on the first
+        request, use 'warm_up' to open connections in advance.
+
+        Requests are throttled to 'rate_limit' requests per second and at
+        most 'max_in_flight' concurrent requests, the rate is lowered
+        automatically while the service reports server errors. A RateLimiter
+        can be passed as 'rate_limiter' instead, e.g. to share it between
+        several API objects.
+
+        Requests failing with transient errors are retried according to
+        'retry_policy', which defaults to RetryPolicy(). Pass
+        RetryPolicy(max_attempts=1) to disable retrying.
+
+        With 'coalesce_gets' concurrent identical GET requests are sent only
+        once and all callers receive the same result, see 'get'.
+
+        'instrumentation' is an Instrumentation object, or a sequence of
+        them, notified about every HTTP request made.
+
+        With a 'tracer', requests and composite operations are recorded as
+        nested spans, see the tracing module.
+
+        'transport' performs the HTTP requests, by default over the aiohttp
+        session. Pass a RecordingTransport to record the traffic to a
+        cassette file, and a ReplayTransport to answer requests from one
+        without network access, see the transport module.
+
+        An existing aiohttp 'session' can be passed to share it between API
+        objects for different accounts, the connection pool options are then
+        ignored and the session is not closed by close. Authentication is
+        sent with every request rather than configured on the session.
+
+        With 'compression' gzip compressed responses are asked for, they are
+        decompressed here, large ones off the event loop. Request bodies of
+        at least 'compress_requests' bytes are gzip compressed too, streamed
+        bodies never are. The bytes saved are counted in
+        'compression_stats'. A shared 'session' should be created with
+        auto_decompress=False for this, otherwise aiohttp decompresses the
+        responses itself.
         """
-        self._auth = aiohttp.BasicAuth(auth_user, auth_key)
+        self._headers = {
+            'authorization': 'Basic {}'.format(base64.b64encode(
+                '{}:{}'.format(auth_user, auth_key).encode('latin1')
+            ).decode('ascii')),
+            'user-agent': user_agent or USER_AGENT,
+            'accept-encoding': compression and ACCEPT_ENCODING or 'identity',
+        }
+        self._compress_requests = compress_requests
+        self._compression_stats = CompressionStats()
         self._items = None
         self._customers = None
         self._billogram = None
         self._settings = None
         self._logotype = None
         self._reports = None
-        self._user_agent = user_agent or USER_AGENT
         self._api_base = api_base or API_URL_BASE
-        self._session = aiohttp.ClientSession(auth=self._auth)
+        if not isinstance(codec, JsonCodec):
+            codec = get_codec(codec)
+        self._codec = codec
+        self._json_loads = json_loads or codec.loads
+        if rate_limiter is None and (rate_limit or max_in_flight):
+            rate_limiter = RateLimiter(
+                rate=rate_limit,
+                max_in_flight=max_in_flight,
+            )
+        self._rate_limiter = rate_limiter
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._coalesce_gets = coalesce_gets
+        self._gets_in_flight = {}
+        if isinstance(instrumentation, Instrumentation):
+            instrumentation = (instrumentation,)
+        self._instrumentation = tuple(instrumentation)
+        self._tracer = tracer
+        self._transport = transport or SessionTransport()
+        # the session is created on the first request, see _get_session
+        self._session = session
+        self._session_owner = session is None
+        self._decode_responses = (
+            session is None or not getattr(session, 'auto_decompress', True))
+        self._connector = connector
+        self._connector_options = {
+            'pool_size': pool_size,
+            'pool_size_per_host': pool_size_per_host,
+            'keepalive_timeout': keepalive_timeout,
+            'dns_cache_ttl': dns_cache_ttl,
+        }
 
     async def close(self):
-        """Close HTTP session"""
-        await self._session.close()
+        """Close HTTP session, unless shared, and transport"""
+        try:
+            if self._session_owner and self._session is not None:
+                await self._session.close()
+                self._session = None
+        finally:
+            await self._transport.close()
 
     async def __aenter__(self):
-        await self._session.__aenter__()
         return self
 
+    def _get_session(self):
+        if self._session is None:
+            if self._connector is None:
+                connector = create_connector(**self._connector_options)
+                connector_owner = True
+            else:
+                connector = self._connector
+                connector_owner = False
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                connector_owner=connector_owner,
+                auto_decompress=False,
+            )
+        return self._session
+
+    def _transport_session(self):
+        # only transports sending over the session get one, so e.g. a
+        # ReplayTransport never creates a session or connection pool
+        if isinstance(self._transport, SessionTransport):
+            return self._get_session()
+        return None
+
+    async def warm_up(self, n_connections=1):
+        """Open connections to the API ahead of the first requests
+
+        Sends 'n_connections' concurrent HEAD requests to the API base URL,
+        resolving its address and completing the TLS handshakes, and leaves
+        the connections in the pool. They are kept for the keep-alive
+        timeout of the pool, and at most its limits are opened. Returns the
+        number of connections warmed up, raises the error of the first
+        failure when none succeeded. Does nothing with a transport not
+        sending requests over the session, e.g. a ReplayTransport.
+        """
+        if not isinstance(self._transport, SessionTransport):
+            return 0
+        session = self._get_session()
+
+        async def connect():
+            async with session.head(
+                    self._api_base,
+                    headers={'user-agent': self._headers['user-agent']},
+            ) as response:
+                await response.read()
+
+        results = await asyncio.gather(
+            *(connect() for _ in range(n_connections)),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+        return len(results) - len(errors)
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._session.__aexit__(exc_type, exc_val, exc_tb)
+        await self.close()
+
+    @property
+    def rate_limiter(self):
+        """The RateLimiter throttling requests, or None if unthrottled"""
+        return self._rate_limiter
+
+    @property
+    def instrumentation(self):
+        """The Instrumentation objects notified about requests"""
+        return self._instrumentation
+
+    @property
+    def compression_stats(self):
+        """The CompressionStats counting bytes saved by compression"""
+        return self._compression_stats
+
+    @property
+    def codec(self):
+        """The JsonCodec serializing request bodies"""
+        return self._codec
+
+    @property
+    def tracer(self):
+        """The Tracer recording spans, or None if tracing is disabled"""
+        return self._tracer
+
+    def trace(self, name, **attributes):
+        """Async context manager running its block in a new span"""
+        if self._tracer is None:
+            return NO_SPAN
+        return self._tracer.span(name, **attributes)
+
+    @property
+    def retry_policy(self):
+        """The RetryPolicy applied to failed requests"""
+        return self._retry_policy
 
     @property
     def items(self):
@@ -112,22 +377,50 @@ class BillogramAPI:
             self._reports = SimpleClass(self, 'report', 'filename')
         return self._reports
 
-    @staticmethod
+    def _decode_json(self, body):
+        """Parse a JSON response body, exactly once per response"""
+        try:
+            return self._json_loads(body)
+        except ValueError:
+            raise ex.ServiceMalfunctioningError(
+                'Billogram API returned malformed JSON'
+            )
+
+    def _parse_response(self, resp, body):
+        """The parsed envelope of a JSON response, None for other types"""
+        if resp.content_type != 'application/json':
+            return None
+        data = self._decode_json(body)
+        if not isinstance(data, dict):
+            raise ex.ServiceMalfunctioningError(
+                'Response data is not a JSON object'
+            )
+        return data
+
     # pylint: disable=too-many-branches
-    async def _check_api_response(resp, expect_content_type=None):
+    def _check_api_response(
+            self, resp, body, expect_content_type=None, data=None):
+        """Map a received response to its result or to an API exception
+
+        'body' is the raw response body as bytes, it is parsed at most once
+        and the parsed envelope is shared by all the checks below. Pass the
+        envelope as 'data' if the body was already parsed.
+        """
         if not resp.ok or expect_content_type is None:
             # if the request failed the response should always be json
             expect_content_type = 'application/json'
 
+        if data is None:
+            data = self._parse_response(resp, body)
+
         if resp.status in range(500, 600):
             # internal error
-            if (resp.content_type == expect_content_type and
+            if (data is not None and
                     expect_content_type == 'application/json'):
-                data = await resp.json()
                 raise ex.ServiceMalfunctioningError(
                     'Billogram API reported a server error: {} - {}'.format(
                         data.get('status'),
-                        data.get('data').get('message')
+                        (data.get('data') or {}).get('message')
                     )
                 )
 
@@ -138,30 +431,27 @@ class BillogramAPI:
         if resp.content_type != expect_content_type:
             # the service returned a different content-type from the expected,
             # probably some malfunction on the remote end
-            if resp.content_type == 'application/json':
-                data = await resp.json()
-                if data.get('status') == 'NOT_AVAILABLE_YET':
-                    raise ex.ObjectNotAvailableYetError(
-                        'Object not available yet'
-                    )
+            if data is not None and data.get('status') == 'NOT_AVAILABLE_YET':
+                raise ex.ObjectNotAvailableYetError(
+                    'Object not available yet'
+                )
             raise ex.ServiceMalfunctioningError(
                 'Billogram API returned unexpected content type'
             )
 
-        if expect_content_type == 'application/json':
-            data = await resp.json()
-            status = data.get('status')
-            if not status:
-                raise ex.ServiceMalfunctioningError(
-                    'Response data missing status field'
-                )
-            if 'data' not in data:
-                raise ex.ServiceMalfunctioningError(
-                    'Response data missing data field'
-                )
-        else:
+        if expect_content_type != 'application/json':
             # per above, non-json responses are always ok, so just return them
-            return await resp.text()
+            return body.decode(resp.charset or 'utf-8')
+
+        status = data.get('status')
+        if not status:
+            raise ex.ServiceMalfunctioningError(
+                'Response data missing status field'
+            )
+        if 'data' not in data:
+            raise ex.ServiceMalfunctioningError(
+                'Response data missing data field'
+            )
 
         if resp.status == 403:
             # bad auth
@@ -185,8 +475,8 @@ class BillogramAPI:
 
         if resp.status == 404:
             # not found
-            if data.get('status') == 'NOT_AVAILABLE_YET':
-                raise ex.ObjectNotFoundError('Object not available yet')
+            if status == 'NOT_AVAILABLE_YET':
+                raise ex.ObjectNotAvailableYetError('Object not available yet')
             raise ex.ObjectNotFoundError('Object not found')
 
         if resp.status == 405:
@@ -196,7 +486,9 @@ class BillogramAPI:
         if status == 'OK':
             return data
 
-        errordata = data.get('data', {})
+        errordata = data.get('data') or {}
+        if 'message' not in errordata:
+            errordata = dict(errordata, message=status)
 
         raise {
             'MISSING_QUERY_PARAMETER': ex.RequestFormError,
@@ -216,43 +508,312 @@ class BillogramAPI:
             params=None,
             data=None,
             expect_content_type=None,
+            retry_safe=False,
     ):
-        """Perform a HTTP request to the Billogram API"""
+        """Perform a HTTP request to the Billogram API
+
+        The response body is read once as bytes and handed on to the
+        response checks, which parse it at most once.
+
+        Failed requests are retried per the retry policy, POST requests only
+        if 'retry_safe' says repeating them can't cause duplicates.
+
+        Request bodies are compressed as configured by 'compress_requests',
+        compressed responses are decoded.
+        """
+        content_encoding = None
+        if (self._compress_requests is not None and
+                isinstance(data, (bytes, str)) and
+                len(data) >= self._compress_requests):
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            original_size = len(data)
+            # once for all attempts
+            data = await compress(data)
+            content_encoding = 'gzip'
+            self._compression_stats.add_request(len(data), original_size)
+        send = functools.partial(
+            self._throttled,
+            functools.partial(
+                self._send, obj, method, params, data, expect_content_type,
+                content_encoding)
+        )
+        async with self.trace(
+                'api.fetch', method=method, endpoint=url_template(obj)):
+            return await self._retry_policy.call(
+                method, obj, send, retry_safe=retry_safe)
+
+    async def _throttled(self, send):
+        if self._rate_limiter is None:
+            return await send()
+        async with self._rate_limiter.slot():
+            try:
+                return await send()
+            except ex.ServiceMalfunctioningError:
+                self._rate_limiter.backoff()
+                raise
+
+    # pylint: disable=too-many-arguments
+    async def download(
+            self,
+            obj,
+            target,
+            params=None,
+            field='content',
+            chunk_size=CHUNK_SIZE,
+    ):
+        """Perform a HTTP GET request streaming a base64 encoded document
+
+        The base64 string 'field' of the response data is decoded as the
+        response arrives and written to 'target', a file path or an object
+        with a regular or coroutine 'write' method, so the document is never
+        held in memory as a whole. Returns the response with the field
+        value emptied. Downloads are not retried, since the target may
+        already have been partially written to.
+        """
+        async with self.trace('api.download', endpoint=url_template(obj)):
+            return await self._throttled(functools.partial(
+                self._download, obj, target, params, field, chunk_size))
+
+    # pylint: disable=too-many-arguments
+    def _instrument(
+            self,
+            method,
+            obj,
+            started,
+            status=None,
+            api_status=None,
+            request_size=0,
+            response_size=0,
+            error=None,
+    ):
+        record = RequestRecord(
+            method,
+            url_template(obj),
+            status,
+            api_status,
+            time.monotonic() - started,
+            request_size,
+            response_size,
+            error,
+        )
+        for instrument in self._instrumentation:
+            instrument.on_request(record)
+
+    def _content_encoding(self, response):
+        if not self._decode_responses:
+            return None
+        encoding = response.headers.get('Content-Encoding')
+        if encoding in (None, '', 'identity'):
+            return None
+        return encoding.lower()
+
+    async def _decode_body(self, response, body):
+        """Decompress a response body according to its encoding"""
+        encoding = self._content_encoding(response)
+        if encoding is None:
+            return body
+        decoded = await decompress(body, encoding)
+        self._compression_stats.add_response(len(body), len(decoded))
+        return decoded
+
+    def _stream_decoder(self, response):
+        encoding = self._content_encoding(response)
+        return encoding and StreamDecoder(encoding)
+
+    # pylint: disable=too-many-arguments,too-many-locals
+    async def _download(self, obj, target, params, field, chunk_size):
         url = '{}/{}'.format(self._api_base, obj)
-        headers = {
-            'user-agent': self._user_agent,
-        }
+        headers = self._headers.copy()
+        started = time.monotonic()
+        status = api_status = error = None
+        received = 0
+        try:
+            async with self._transport.stream(
+                    self._transport_session(), url, params,
+                    headers) as response:
+                status = response.status
+                if (not response.ok or
+                        response.content_type != 'application/json'):
+                    # errors come as small complete documents
+                    body = await response.read()
+                    received = len(body)
+                    body = await self._decode_body(response, body)
+                    envelope = self._parse_response(response, body)
+                    api_status = envelope and envelope.get('status')
+                    self._check_api_response(
+                        response, body, 'application/json', envelope)
+                    raise ex.ServiceMalfunctioningError(
+                        'Billogram API returned unexpected content type'
+                    )
+                extractor = Base64FieldExtractor(field)
+                decoder = self._stream_decoder(response)
+                async with open_sink(target) as write:
+                    async for chunk in response.content.iter_chunked(
+                            chunk_size):
+                        received += len(chunk)
+                        if decoder is not None:
+                            chunk = decoder.feed(chunk)
+                        decoded = extractor.feed(chunk)
+                        if decoded:
+                            await write(decoded)
+                    if decoder is not None:
+                        decoded = extractor.feed(decoder.close())
+                        if decoded:
+                            await write(decoded)
+                        self._compression_stats.add_response(
+                            decoder.wire_size, decoder.decoded_size)
+                    body = extractor.close()
+                    envelope = self._parse_response(response, body)
+                    api_status = envelope.get('status')
+                    envelope = self._check_api_response(
+                        response, body, 'application/json', envelope)
+                    if not extractor.found:
+                        raise ex.ServiceMalfunctioningError(
+                            'Response data missing {} field'.format(field)
+                        )
+            return envelope
+        except Exception as err:
+            error = type(err)
+            raise
+        finally:
+            if self._instrumentation:
+                self._instrument(
+                    'GET', obj, started, status, api_status,
+                    response_size=received, error=error)
+
+    # pylint: disable=too-many-arguments
+    async def _send(self, obj, method, params, data, expect_content_type,
+                    content_encoding=None):
+        url = '{}/{}'.format(self._api_base, obj)
+        headers = self._headers.copy()
         if data:
             headers['content-type'] = 'application/json'
-        response = await self._session.request(
-            method=method,
-            url=url,
-            params=params,
-            data=data,
-            headers=headers,
-        )
-        await response.text()
-        return await self._check_api_response(
-            response, expect_content_type=expect_content_type)
+        if content_encoding:
+            headers['content-encoding'] = content_encoding
+        request_size = len(data) if isinstance(data, (bytes, str)) else 0
+        if self._instrumentation and hasattr(data, '__aiter__'):
+            chunks = data
+
+            async def counted():
+                nonlocal request_size
+                async for chunk in chunks:
+                    request_size += len(chunk)
+                    yield chunk
+            data = counted()
+        started = time.monotonic()
+        status = api_status = error = None
+        response_size = 0
+        try:
+            response, body = await self._transport.request(
+                self._transport_session(), method, url, params, data,
+                headers)
+            status = response.status
+            response_size = len(body)
+            body = await self._decode_body(response, body)
+            envelope = self._parse_response(response, body)
+            api_status = envelope and envelope.get('status')
+            return self._check_api_response(
+                response, body, expect_content_type, envelope)
+        except Exception as err:
+            error = type(err)
+            raise
+        finally:
+            if self._instrumentation:
+                self._instrument(
+                    method, obj, started, status, api_status,
+                    request_size=request_size,
+                    response_size=response_size,
+                    error=error,
+                )
 
     async def get(self, obj, params=None, expect_content_type=None):
-        """Perform a HTTP GET request to the Billogram API"""
+        """Perform a HTTP GET request to the Billogram API
+
+        A GET identical to one already in flight waits for that request
+        instead of sending its own, and gets the same result object (which
+        is to be treated as read-only) or exception. Cancelling one waiter
+        leaves the request running for the others, it is only cancelled
+        when no waiters remain.
+        """
+        if not self._coalesce_gets:
+            return await self.fetch(
+                obj, 'GET',
+                params=params, expect_content_type=expect_content_type)
+
+        key = (
+            obj,
+            tuple(sorted((str(k), str(v)) for k, v in (params or {}).items())),
+            expect_content_type,
+        )
+        flight = self._gets_in_flight.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(self.fetch(
+                obj, 'GET',
+                params=params, expect_content_type=expect_content_type)))
+            self._gets_in_flight[key] = flight
+            flight.task.add_done_callback(
+                lambda _: self._end_flight(key, flight))
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # every waiter was cancelled, nobody wants the result
+                self._end_flight(key, flight)
+                flight.task.cancel()
+
+    def _end_flight(self, key, flight):
+        if self._gets_in_flight.get(key) is flight:
+            del self._gets_in_flight[key]
+
+    def forget_gets(self, obj):
+        """Stop sharing the GET requests for 'obj' already in flight
+
+        Their current waiters still receive their results, but later calls
+        to 'get' send new requests, e.g. since the object was changed after
+        the requests in flight were sent.
+        """
+        for key in [k for k in self._gets_in_flight if k[0] == obj]:
+            del self._gets_in_flight[key]
+
+    async def post(self, obj, data, retry_safe=False):
+        """Perform a HTTP POST request to the Billogram API
+
+        Set 'retry_safe' if the request can be repeated without side effects
+        should it fail, failed POST requests are not retried otherwise.
+        """
         return await self.fetch(
-            obj, 'GET', params=params, expect_content_type=expect_content_type)
+            obj, 'POST', data=self._codec.dumps(data), retry_safe=retry_safe)
+
+    async def post_stream(self, obj, body):
+        """Perform a HTTP POST request with a body produced incrementally
 
-    async def post(self, obj, data):
-        """Perform a HTTP POST request to the Billogram API"""
-        return await self.fetch(obj, 'POST', data=json.dumps(data))
+        'body' is an async iterable of the bytes of a JSON document. Such
+        requests are never retried, as the body can't be produced again.
+        """
+        return await self.fetch(obj, 'POST', data=body)
 
     async def put(self, obj, data):
         """Perform a HTTP PUT request to the Billogram API"""
-        return await self.fetch(obj, 'PUT', data=json.dumps(data))
+        return await self.fetch(obj, 'PUT', data=self._codec.dumps(data))
 
     async def delete(self, obj):
         """Perform a HTTP DELETE request to the Billogram API"""
         return await self.fetch(obj, 'DELETE')
 
 
+class _Flight:
+    """A GET request in flight and the number of callers waiting for it"""
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
 class SingletonObject:
     """Represents a remote singleton object on Billogram
 
@@ -305,7 +866,12 @@ class SingletonObject:
 
     async def update(self, data):
         """Modify the remote object with a partial or complete structure"""
-        resp = await self._api.put(await self.url(), data)
+        url = await self.url()
+        try:
+            resp = await self._api.put(url, data)
+        finally:
+            # GETs sent before the change must not be joined after it
+            self._api.forget_gets(url)
         self._data = resp['data']
         return self
 
@@ -342,9 +908,26 @@ class SimpleObject(SingletonObject):
     async def get(self, key):
         return self._data[key]
 
+    async def update(self, data):
+        """Modify the remote object with a partial or complete structure"""
+        object_id = await self.get_id()
+        try:
+            return await super().update(data)
+        finally:
+            # also when failing, the change may still have been applied
+            self._object_class.invalidate(object_id)
+
     async def delete(self):
         """Remove the remote object from the database"""
-        await self._api.delete(await self.url())
+        object_id = await self.get_id()
+        try:
+            await self._api.delete(await self.url())
+        finally:
+            self._object_class.invalidate(object_id)
+
+    async def get_id(self):
+        """Identification of the object within its collection"""
+        return self._data.get(self._object_class.object_id_field)
 
 
 class Query:
@@ -377,6 +960,7 @@ class Query:
             query_args,
         )
         self._count_cached = resp['meta']['total_count']
+        self._type_class.store_count(self.filter, self._count_cached)
         return resp
 
     def _get_queryargs(self):
@@ -385,19 +969,30 @@ class Query:
         args.update(self.order)
         return args
 
-    async def count(self):
+    async def count(self, use_cache=True):
         """Total amount of objects matched by the current query, reading this
-        may cause a remote request"""
+        may cause a remote request
+
+        The count may come from the shared count cache of the class, see
+        SimpleClass.enable_count_cache, unless 'use_cache' is unset. While
+        that cache is enabled it is consulted on every call, so counts
+        expire after its TTL for long-lived queries too.
+        """
+        if not use_cache:
+            self._count_cached = None
+        elif self._type_class.count_cache is not None:
+            # the query's own copy would never expire
+            self._count_cached = self._type_class.cached_count(self.filter)
         if self._count_cached is None:
             # make a query for a single result,
             # this will update the cached count
             await self._make_query(1, 1)
         return self._count_cached
 
-    async def total_pages(self):
+    async def total_pages(self, use_cache=True):
         """Total number of pages required for all objects based on current
         pagesize, reading this may cause a remote request"""
-        _count = await self.count()
+        _count = await self.count(use_cache)
         return (_count + self.page_size - 1) // self.page_size
 
     @property
@@ -497,8 +1092,14 @@ class Query:
             (exact meaning depends on object type)"""
         return self.make_filter('special', 'search', search_terms)
 
-    async def get_page(self, page_number):
-        """Fetch objects for the one-based page number"""
+    def compound(self, select_by_count=True):
+        """Create a query combining several filters, see CompoundQuery
+
+        The compound query keeps the page size and order of this query.
+        """
+        return CompoundQuery(self, select_by_count=select_by_count)
+
+    async def _fetch_page(self, page_number):
         resp = await self._make_query(int(page_number))
         cls = await self._type_class.url()
         return [
@@ -507,19 +1108,157 @@ class Query:
                 self._type_class,
                 o
             ) for o in resp['data']
-        ]
+        ], resp['meta']['total_count']
+
+    async def get_page(self, page_number):
+        """Fetch objects for the one-based page number"""
+        objects, _ = await self._fetch_page(page_number)
+        return objects
+
+    async def iter_pages(self, prefetch=0):
+        """Iterate over all pages of matched objects
 
-    async def iter_all(self):
-        """Iterate over all matched objects"""
+        'prefetch' is the number of pages to fetch concurrently ahead of the
+        page being consumed. Pages are always yielded in order, and at most
+        prefetch + 1 pages are held in memory at any time.
+        """
+        prefetch = int(prefetch)
+        assert prefetch >= 0
         # make a copy of ourselves so parameters can't be changed behind
         # our back
         qry = copy.copy(self)
-        # iterate over every object on every page
-        pages = await qry.total_pages()
-        for page_number in range(1, pages + 1):
-            page = await qry.get_page(page_number)
-            for obj in page:
-                yield obj
+        # the pages are fetched in between yields and in separate tasks,
+        # so the span is never made current in the consumer's context
+        tracer = self._type_class.api.tracer
+        span = None
+        if tracer is not None:
+            span = tracer.start_span(
+                'query.iter_pages',
+                url_name=self._type_class.url_name,
+                prefetch=prefetch,
+            )
+
+        def traced(awaitable):
+            if span is None:
+                return awaitable
+            return tracer.activate(span, awaitable)
+
+        pending = collections.deque()
+        error = None
+        try:
+            # a cached count could be stale and end the iteration early
+            pages = await traced(qry.total_pages(use_cache=False))
+            next_page = 1
+            while next_page <= pages or pending:
+                while next_page <= pages and len(pending) <= prefetch:
+                    pending.append(asyncio.ensure_future(
+                        traced(qry.get_page(next_page))
+                    ))
+                    next_page += 1
+                yield await pending.popleft()
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            # the consumer stopped early or a page failed, don't leave
+            # prefetched requests running in the background
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            if span is not None:
+                tracer.finish_span(span, error)
+
+    async def iter_all(self, prefetch=0):
+        """Iterate over all matched objects
+
+        See 'iter_pages' for the meaning of 'prefetch'.
+        """
+        pages = self.iter_pages(prefetch)
+        try:
+            # iterate over every object on every page
+            async for page in pages:
+                for obj in page:
+                    yield obj
+        finally:
+            await pages.aclose()
+
+    # pylint: disable=too-many-locals
+    async def iter_stable(
+            self,
+            order_field='created_at',
+            prefetch=0,
+            max_rewinds=100,
+            stats=None,
+    ):
+        """Iterate over all matched objects, robust against concurrent changes
+
+        Pages are fetched ordered ascending by 'order_field', which should
+        be a field that never changes, so objects created during the
+        iteration come last. Every object is yielded only once, tracked by
+        its identification.
+
+        The total count returned with every page is compared with the
+        previous one. When it dropped, objects were removed from before the
+        current position and the following ones shifted to earlier pages,
+        so the iteration rewinds just far enough to cover the shift (at most
+        'max_rewinds' times) instead of silently skipping them. Removals
+        offset by an equal number of additions between two pages leave the
+        count unchanged and can't be detected this way.
+
+        See 'iter_pages' for the meaning of 'prefetch'. If a 'stats' dict is
+        given, it is updated with the number of 'pages' fetched, 'rewinds'
+        done and 'duplicates' dropped.
+        """
+        prefetch = int(prefetch)
+        assert prefetch >= 0
+        qry = copy.copy(self)
+        qry.order = {'order_field': order_field, 'order_direction': 'asc'}
+        if stats is None:
+            stats = {}
+        stats.update(pages=0, rewinds=0, duplicates=0)
+        seen = set()
+        total = await qry.count(use_cache=False)
+        pending = collections.deque()
+        next_page = 1
+
+        async def cancel_pending():
+            for _, task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(
+                    *(task for _, task in pending), return_exceptions=True)
+            pending.clear()
+
+        try:
+            while True:
+                pages = (total + qry.page_size - 1) // qry.page_size
+                while next_page <= pages and len(pending) <= prefetch:
+                    pending.append((
+                        next_page,
+                        asyncio.ensure_future(qry._fetch_page(next_page))
+                    ))
+                    next_page += 1
+                if not pending:
+                    return
+                page_number, task = pending.popleft()
+                objects, count = await task
+                stats['pages'] += 1
+                for obj in objects:
+                    object_id = await obj.get_id()
+                    if object_id in seen:
+                        stats['duplicates'] += 1
+                        continue
+                    seen.add(object_id)
+                    yield obj
+                if count < total and stats['rewinds'] < max_rewinds:
+                    stats['rewinds'] += 1
+                    shifted_pages = -(-(total - count) // qry.page_size)
+                    await cancel_pending()
+                    next_page = max(1, page_number - shifted_pages)
+                total = count
+        finally:
+            await cancel_pending()
 
 
 class SimpleClass:
@@ -535,6 +1274,8 @@ class SimpleClass:
         self._api = api
         self._url_name = url_name
         self._object_id_field = object_id_field
+        self._cache = None
+        self._count_cache = None
 
     async def url_of(self, obj=None, obj_id=None):
         """Get url of"""
@@ -556,21 +1297,135 @@ class SimpleClass:
         """Get api"""
         return self._api
 
+    @property
+    def object_id_field(self):
+        """Name of the field identifying objects of this type"""
+        return self._object_id_field
+
+    @property
+    def cache(self):
+        """The ObjectCache used by 'get', or None if caching is disabled"""
+        return self._cache
+
+    def enable_cache(self, max_entries=1000, ttl=60.0):
+        """Cache objects fetched by 'get' in-process
+
+        At most 'max_entries' objects are kept for up to 'ttl' seconds.
+        Cached objects are invalidated when updated, deleted or created
+        through this library, changes made elsewhere are only seen once
+        the entry expires.
+        """
+        self._cache = ObjectCache(max_entries=max_entries, ttl=ttl)
+        return self
+
+    def disable_cache(self):
+        """Stop caching objects fetched by 'get'"""
+        self._cache = None
+        return self
+
+    @property
+    def count_cache(self):
+        """The ObjectCache of query counts, or None if disabled"""
+        return self._count_cache
+
+    def enable_count_cache(self, max_entries=1000, ttl=30.0):
+        """Share query counts between all queries of this type
+
+        Counts are kept for 'ttl' seconds and keyed by the query filter, as
+        the order does not change how many objects match. Changing objects
+        through this library clears the cached counts. Only 'count' and the
+        counting helpers read the cache, iterating over a query always takes
+        a fresh count.
+        """
+        self._count_cache = ObjectCache(max_entries=max_entries, ttl=ttl)
+        return self
+
+    @staticmethod
+    def _count_key(query_filter):
+        return tuple(sorted((k, str(v)) for k, v in query_filter.items()))
+
+    def cached_count(self, query_filter):
+        """Cached count for the query filter, or None"""
+        if self._count_cache is None:
+            return None
+        return self._count_cache.get(self._count_key(query_filter))
+
+    def store_count(self, query_filter, count):
+        """Remember the count for the query filter"""
+        if self._count_cache is not None:
+            self._count_cache.put(self._count_key(query_filter), count)
+
+    async def count_many(self, queries):
+        """Count the objects matched by several queries concurrently
+
+        'queries' are Query objects or filter dicts as taken by
+        Query.filter. Returns the counts in the same order. Enable the count
+        cache to reuse recent counts between calls.
+        """
+        prepared = []
+        for query in queries:
+            if not isinstance(query, Query):
+                query_filter, query = query, self.query()
+                query.filter = query_filter
+            prepared.append(query)
+        return list(await asyncio.gather(*(q.count() for q in prepared)))
+
+    def invalidate(self, object_id):
+        """Drop any cached copy of the object with the given identification,
+        and any cached counts
+
+        GET requests for the object or its queries already in flight are
+        not joined by later calls either, as they may return the old data.
+        """
+        if object_id is not None:
+            self.api.forget_gets('{}/{}'.format(self.url_name, object_id))
+        self.api.forget_gets(self.url_name)
+        if self._cache is not None and object_id is not None:
+            self._cache.invalidate(str(object_id))
+        if self._count_cache is not None:
+            # the change may move the object in or out of any query
+            self._count_cache.clear()
+
     def query(self):
         """Create a query for objects of this type"""
         return Query(self)
 
     async def get(self, object_id):
         """Fetch a single object by its identification"""
+        cache = self._cache
+        if cache is not None:
+            data = cache.get(str(object_id))
+            if data is not None:
+                return self._object_class(self.api, self, data)
+            generation = cache.generation
         url = await self.url_of(obj_id=object_id)
         resp = await self.api.get(url)
+        if cache is not None:
+            cache.put(str(object_id), resp['data'], generation)
         return self._object_class(self.api, self, resp['data'])
 
     async def create(self, data):
         """Create a new object with the given data"""
         resp = await self.api.post(self.url_name, data)
+        self.invalidate(resp['data'].get(self._object_id_field))
         return self._object_class(self.api, self, resp['data'])
 
+    async def create_many(self, records, concurrency=10):
+        """Create a new object for each data dict in 'records'
+
+        'records' can be a regular or an async iterable, it is consumed as
+        objects are created with at most 'concurrency' requests in flight.
+        Yields a BulkResult per record in completion order, holding either
+        the created object or the exception raised when creating it. A
+        failing record does not stop the others.
+        """
+        results = bounded_map(records, self.create, concurrency)
+        try:
+            async for result in results:
+                yield result
+        finally:
+            await results.aclose()
+
 
 class BillogramObject(SimpleObject):
     """Represents a billogram object on the Billogram service
@@ -585,8 +1440,17 @@ class BillogramObject(SimpleObject):
     async def perform_event(self, evt_name, evt_data=None):
         """Perform a generic state transition event on billogram object
         """
+        return await self._perform_event(evt_name, self._api.post, evt_data)
+
+    async def _perform_event(self, evt_name, post, body):
         url = '{}/command/{}'.format(await self.url(), evt_name)
-        resp = await self._api.post(url, evt_data)
+        object_id = await self.get_id()
+        try:
+            async with self._api.trace(
+                    'billogram.perform_event', event=evt_name):
+                resp = await post(url, body)
+        finally:
+            self._object_class.invalidate(object_id)
         self._data = resp['data']
         return self
 
@@ -714,19 +1578,51 @@ class BillogramObject(SimpleObject):
         resp = await self._api.get(url, expect_content_type='application/json')
         return base64.b64decode(resp['data']['content'])
 
-    async def attach_pdf(self, filepath):
-        """Attach a PDF to the billogram
+    async def save_invoice_pdf(self, target, letter_id=None, invoice_no=None):
+        """Stream the PDF content for a specific invoice on this billogram
+
+        'target' is a file path or an object with a regular or coroutine
+        'write' method, the PDF is written to it as it is downloaded and
+        decoded. Paths are written under a temporary name and only appear
+        once complete. Returns the response data, without the content.
         """
-        with open(filepath) as f_pdf:
-            content = f_pdf.read()
+        url = '{}.pdf'.format(await self.url())
 
-        filename = os.path.basename(filepath)
-        return await self.perform_event(
+        params = {}
+        if letter_id:
+            params['letter_id'] = letter_id
+        if invoice_no:
+            params['invoice_no'] = invoice_no
+        resp = await self._api.download(url, target, params)
+        return resp['data']
+
+    async def save_attachment_pdf(self, target):
+        """Stream the PDF attachment for the billogram
+
+        See 'save_invoice_pdf' for the meaning of 'target'.
+        """
+        url = '{}/attachment.pdf'.format(await self.url())
+
+        resp = await self._api.download(url, target)
+        return resp['data']
+
+    async def attach_pdf(self, source, filename=None):
+        """Attach a PDF to the billogram
+
+        'source' is a file path, the PDF content as bytes, a binary file
+        object or an object with a coroutine 'read' method. It is read and
+        base64 encoded in chunks off the event loop while being uploaded.
+        'filename' defaults to the name of the file when given a path.
+        """
+        if filename is None:
+            if isinstance(source, (str, os.PathLike)):
+                filename = os.path.basename(source)
+            else:
+                filename = 'attachment.pdf'
+        return await self._perform_event(
             'attach',
-            {
-                'content': base64.b64encode(content),
-                'filename': filename,
-            }
+            self._api.post_stream,
+            iter_base64_json_body(source, {'filename': filename}),
         )
 
     async def writeoff(self):
@@ -747,6 +1643,9 @@ class BillogramQuery(Query):
         assert all(isinstance(s, str) for s in states)
         return self.filter_field('state', ','.join(states))
 
+    def compound(self, select_by_count=True):
+        return BillogramCompoundQuery(self, select_by_count=select_by_count)
+
 
 class BillogramClass(SimpleClass):
     """Represents the collection of billogram objects on the Billogram service
@@ -764,6 +1663,74 @@ class BillogramClass(SimpleClass):
         """Create a query for billogram objects"""
         return BillogramQuery(self)
 
+    async def _event_targets(self, source, prefetch):
+        if isinstance(source, Query):
+            # events can move billograms out of the query filter, shifting
+            # the later pages, so collect all ids before running any
+            source = [
+                await obj.get_id()
+                async for obj in source.iter_all(prefetch=prefetch)
+            ]
+        async for item in aiter_any(source):
+            if isinstance(item, BillogramObject):
+                yield item
+            else:
+                # the event url only needs the id, so don't fetch the
+                # object, the event response brings its full data anyway
+                yield self._object_class(
+                    self.api, self, {self._object_id_field: item})
+
+    # pylint: disable=too-many-arguments
+    async def perform_event_many(
+            self,
+            source,
+            evt_name,
+            evt_data=None,
+            concurrency=10,
+            prefetch=1,
+            progress=None,
+    ):
+        """Perform a state transition event on many billogram objects
+
+        'source' is a BillogramQuery, or a regular or async iterable of
+        billogram ids or objects. The ids of all billograms matched by a
+        query are collected (fetching 'prefetch' pages ahead) before the
+        first event is performed, since events can change which billograms
+        the query matches. At most 'concurrency' event requests are in
+        flight.
+
+        Yields a BulkResult per billogram in completion order, holding the
+        updated billogram object or the exception raised by the event. If
+        'progress' is given it is called with a BulkProgress after every
+        finished billogram.
+        """
+        async def perform(billogram):
+            return await billogram.perform_event(evt_name, evt_data)
+
+        totals = BulkProgress()
+        results = bounded_map(
+            self._event_targets(source, prefetch), perform, concurrency)
+        try:
+            async for result in results:
+                totals.add(result)
+                if progress is not None:
+                    progress(totals)
+                yield result
+        finally:
+            await results.aclose()
+
+    async def count_by_state(self, *states):
+        """Count billogram objects in each of the listed states
+
+        The counts are made concurrently, returns a dict of counts by state.
+        """
+        if (len(states) == 1 and isinstance(
+                states[0], (list, tuple, set, frozenset))):
+            states = states[0]
+        states = list(states)
+        queries = [self.query().filter_state_any(state) for state in states]
+        return dict(zip(states, await self.count_many(queries)))
+
     async def create_and_send(self, data, method):
         """Create the billogram and send it to the recipient in one operation
 
@@ -776,13 +1743,14 @@ class BillogramClass(SimpleClass):
         would be zero).
         """
         assert method in ('Email', 'Letter', 'Email+Letter')
-        billogram = await self.create(data)
-        try:
-            await billogram.send(method)
-        except Exception as err:
-            await billogram.delete()
-            raise err
-        return billogram
+        async with self.api.trace('billogram.create_and_send', method=method):
+            billogram = await self.create(data)
+            try:
+                await billogram.send(method)
+            except Exception as err:
+                await billogram.delete()
+                raise err
+            return billogram
 
     async def create_and_sell(self, data):
         """Create the billogram and send it to factoring in one operation
@@ -0,0 +1,146 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Helpers for running many Billogram API operations concurrently"""
+
+import asyncio
+import time
+
+
+class BulkResult:
+    """Outcome of one input record of a bulk operation
+
+    'index' is the position of the record in the input, 'input' the record
+    itself. On success 'result' holds the value returned by the operation,
+    on failure 'error' holds the exception raised.
+    """
+    __slots__ = ('index', 'input', 'result', 'error')
+
+    def __init__(self, index, input_, result=None, error=None):
+        self.index = index
+        self.input = input_
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        """Whether the operation succeeded for this record"""
+        return self.error is None
+
+    def __repr__(self):
+        return '<BulkResult #{} {}>'.format(
+            self.index,
+            self.ok and 'ok' or repr(self.error)
+        )
+
+
+class BulkProgress:
+    """Running totals of a bulk operation"""
+    __slots__ = ('done', 'succeeded', 'failed', 'started')
+
+    def __init__(self):
+        self.done = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        """Seconds since the operation started"""
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        """Finished items per second so far"""
+        elapsed = self.elapsed
+        return elapsed and self.done / elapsed
+
+    def add(self, result):
+        """Account for a finished BulkResult"""
+        self.done += 1
+        if result.ok:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    def __repr__(self):
+        return '<BulkProgress done={} succeeded={} failed={}>'.format(
+            self.done, self.succeeded, self.failed)
+
+
+async def aiter_any(items):
+    """Iterate asynchronously over a regular or an async iterable"""
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def _run_one(index, item, operation):
+    try:
+        return BulkResult(index, item, result=await operation(item))
+    except Exception as err:  # pylint: disable=broad-except
+        return BulkResult(index, item, error=err)
+
+
+async def bounded_map(items, operation, concurrency):
+    """Run the coroutine function 'operation' on every item of 'items'
+
+    'items' can be a regular or an async iterable and is consumed lazily,
+    keeping at most 'concurrency' operations running at once. A BulkResult
+    is yielded for every item as soon as its operation finishes, so results
+    come in completion order, use their 'index' to restore input order.
+    Failing operations are reported in their result and don't stop the
+    others.
+    """
+    concurrency = int(concurrency)
+    assert concurrency >= 1
+    source = aiter_any(items)
+    pending = set()
+    index = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    item = await source.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending.add(
+                    asyncio.ensure_future(_run_one(index, item, operation))
+                )
+                index += 1
+            if not pending:
+                return
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await source.aclose()
@@ -0,0 +1,110 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""In-process caching of Billogram API objects"""
+
+import collections
+import time
+
+
+class ObjectCache:
+    """LRU cache of object data with a time to live
+
+    Holds at most 'max_entries' entries, evicting the least recently used
+    one when full. Entries older than 'ttl' seconds are treated as missing
+    (None keeps them until evicted or invalidated).
+
+    Lookups that race with an invalidation are handled by 'generation':
+    take it before fetching and pass it to 'put', which then drops the
+    result if the cache was invalidated meanwhile.
+    """
+    def __init__(self, max_entries=1000, ttl=60.0):
+        assert max_entries >= 1
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def generation(self):
+        """Counter increased by every invalidation"""
+        return self._generation
+
+    def stats(self):
+        """Snapshot of the cache counters"""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
+
+    def get(self, key):
+        """Cached value for 'key', or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, generation=None):
+        """Store 'value' for 'key', unless invalidated since 'generation'"""
+        if generation is not None and generation != self._generation:
+            return
+        expires = None
+        if self._ttl is not None:
+            expires = time.monotonic() + self._ttl
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop any entry for 'key'"""
+        self._generation += 1
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        """Drop all entries"""
+        self._generation += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
@@ -0,0 +1,104 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""JSON codecs for request and response bodies
+
+The fastest JSON library installed is used by default: orjson, ujson or
+the standard library json module, in that order of preference.
+"""
+
+import json
+
+
+class JsonCodec:
+    """A named pair of JSON functions
+
+    'dumps' serializes an object to UTF-8 encoded bytes, 'loads' parses
+    bytes (or str).
+    """
+    __slots__ = ('name', 'dumps', 'loads')
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<JsonCodec {}>'.format(self.name)
+
+
+def _stdlib_codec():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        return encoder.encode(obj).encode('utf-8')
+    return JsonCodec('json', dumps, json.loads)
+
+
+def _orjson_codec():
+    import orjson  # pylint: disable=import-outside-toplevel
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return JsonCodec('orjson', dumps, orjson.loads)
+
+
+def _ujson_codec():
+    import ujson  # pylint: disable=import-outside-toplevel
+
+    def dumps(obj):
+        return ujson.dumps(
+            obj,
+            ensure_ascii=False,
+            escape_forward_slashes=False,
+        ).encode('utf-8')
+    return JsonCodec('ujson', dumps, ujson.loads)
+
+
+_FACTORIES = {
+    'orjson': _orjson_codec,
+    'ujson': _ujson_codec,
+    'json': _stdlib_codec,
+}
+_codecs = {}
+
+
+def get_codec(name='auto'):
+    """The JsonCodec of the library 'name', or of the fastest installed one
+    with 'auto'
+
+    Raises ImportError when the named library is not installed.
+    """
+    if name in _codecs:
+        return _codecs[name]
+    if name == 'auto':
+        for candidate in _FACTORIES:
+            try:
+                codec = get_codec(candidate)
+            except ImportError:
+                continue
+            _codecs[name] = codec
+            return codec
+    if name not in _FACTORIES:
+        raise ValueError('Unknown JSON codec {!r}'.format(name))
+    codec = _codecs[name] = _FACTORIES[name]()
+    return codec
@@ -0,0 +1,239 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Queries combining several filters on the Billogram v2 API"""
+
+import asyncio
+import copy
+
+
+def field_value(data, field):
+    """Value of a possibly nested field, 'customer:customer_no' style"""
+    for part in field.split(':'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+def _match_field(actual, value):
+    # the API takes comma separated alternatives, e.g. for states
+    return actual is not None and (
+        str(actual) == str(value) or str(actual) in str(value).split(','))
+
+
+def _match_prefix(actual, value):
+    return actual is not None and str(actual).startswith(str(value))
+
+
+def _match_search(actual, value):
+    return actual is not None and str(value).lower() in str(actual).lower()
+
+
+_MATCHERS = {
+    'field': _match_field,
+    'field-prefix': _match_prefix,
+    'field-search': _match_search,
+}
+
+
+class Predicate:
+    """One condition of a compound query
+
+    Predicates with a 'filter_type' can be sent to the server as a query
+    filter. All predicates can be tested locally, either by 'test' if
+    given (a callable taking the object data) or by emulating the filter.
+    Special queries can only be tested locally when given a 'test'.
+    """
+    __slots__ = ('filter_type', 'filter_field', 'filter_value', 'test')
+
+    def __init__(
+            self,
+            filter_type=None,
+            filter_field=None,
+            filter_value=None,
+            test=None,
+    ):
+        if test is None:
+            assert filter_type in _MATCHERS or filter_type == 'special'
+        self.filter_type = filter_type
+        self.filter_field = filter_field
+        self.filter_value = filter_value
+        self.test = test
+
+    @property
+    def server_side(self):
+        """Whether the predicate can be applied as a query filter"""
+        return self.filter_type is not None
+
+    @property
+    def client_side(self):
+        """Whether the predicate can be tested on fetched objects"""
+        return self.test is not None or self.filter_type in _MATCHERS
+
+    def as_filter(self):
+        """The predicate as a Query filter dict"""
+        return {
+            'filter_type': self.filter_type,
+            'filter_field': self.filter_field,
+            'filter_value': self.filter_value,
+        }
+
+    def matches(self, data):
+        """Test the predicate on the data of an object"""
+        if self.test is not None:
+            return self.test(data)
+        return _MATCHERS[self.filter_type](
+            field_value(data, self.filter_field), self.filter_value)
+
+    def __repr__(self):
+        if self.filter_type is None:
+            return '<Predicate {!r}>'.format(self.test)
+        return '<Predicate {} {} {!r}>'.format(
+            self.filter_type, self.filter_field, self.filter_value)
+
+
+class CompoundQuery:
+    """Query matching objects on all of several conditions
+
+    The Billogram API can only filter on one condition at a time, so one
+    predicate is pushed down to the server as the query filter and the
+    others are applied locally on the objects streamed by 'iter_all'. With
+    'select_by_count' the pushed predicate is the one matching the fewest
+    objects, found by counting each candidate remotely; otherwise it is
+    the first one added.
+
+    A filter already set on 'query' is the first condition.
+
+    After iterating, 'fetched' and 'matched' tell how many objects were
+    transferred and how many of those matched all conditions.
+    """
+    def __init__(self, query, select_by_count=True):
+        self._query = query
+        self._select_by_count = select_by_count
+        self._predicates = []
+        self.pushed = None
+        self.counts = {}
+        self.fetched = 0
+        self.matched = 0
+        query_filter = query.filter
+        if query_filter:
+            self.add(Predicate(
+                query_filter['filter_type'],
+                query_filter['filter_field'],
+                query_filter['filter_value'],
+            ))
+
+    @property
+    def predicates(self):
+        """All conditions of the query"""
+        return list(self._predicates)
+
+    def add(self, predicate):
+        """Add a Predicate to the conditions"""
+        if not predicate.client_side and any(
+                not p.client_side for p in self._predicates):
+            raise ValueError(
+                'Only one special query without a local test can be used'
+            )
+        self._predicates.append(predicate)
+        self.pushed = None
+        return self
+
+    def filter_field(self, filter_field, filter_value):
+        """Require exact matches on a basic field"""
+        return self.add(Predicate('field', filter_field, filter_value))
+
+    def filter_prefix(self, filter_field, filter_value):
+        """Require prefix matches on a basic field"""
+        return self.add(Predicate('field-prefix', filter_field, filter_value))
+
+    def filter_search(self, filter_field, filter_value):
+        """Require substring matches on a basic field"""
+        return self.add(Predicate('field-search', filter_field, filter_value))
+
+    def filter_special(self, filter_field, filter_value, test=None):
+        """Require a match on a special query
+
+        Unless 'test' is given to evaluate it locally, a special query is
+        always the one pushed down to the server.
+        """
+        return self.add(
+            Predicate('special', filter_field, filter_value, test))
+
+    def where(self, test):
+        """Require 'test', called with the object data, to return true"""
+        return self.add(Predicate(test=test))
+
+    def _query_for(self, predicate):
+        qry = copy.copy(self._query)
+        qry.filter = predicate.as_filter() if predicate else {}
+        return qry
+
+    async def choose_pushdown(self):
+        """Select the predicate to send to the server, if any"""
+        if self.pushed is not None:
+            return self.pushed
+        candidates = [p for p in self._predicates if p.server_side]
+        forced = [p for p in candidates if not p.client_side]
+        if forced:
+            self.pushed = forced[0]
+        elif len(candidates) > 1 and self._select_by_count:
+            counts = await asyncio.gather(
+                *(self._query_for(p).count() for p in candidates))
+            self.counts = dict(zip(candidates, counts))
+            self.pushed = candidates[counts.index(min(counts))]
+        elif candidates:
+            self.pushed = candidates[0]
+        return self.pushed
+
+    async def iter_all(self, prefetch=0):
+        """Iterate over all objects matching every condition
+
+        See Query.iter_pages for the meaning of 'prefetch'.
+        """
+        pushed = await self.choose_pushdown()
+        local = [p for p in self._predicates if p is not pushed]
+        self.fetched = 0
+        self.matched = 0
+        objects = self._query_for(pushed).iter_all(prefetch=prefetch)
+        try:
+            async for obj in objects:
+                self.fetched += 1
+                data = await obj.data()
+                if all(p.matches(data) for p in local):
+                    self.matched += 1
+                    yield obj
+        finally:
+            await objects.aclose()
+
+
+class BillogramCompoundQuery(CompoundQuery):
+    """Compound query for billogram objects"""
+
+    def filter_state_any(self, *states):
+        "Require billogram objects to have any of the listed states"
+        if (len(states) == 1 and isinstance(
+                states[0], (list, tuple, set, frozenset))):
+            states = states[0]
+        assert all(isinstance(s, str) for s in states)
+        return self.filter_field('state', ','.join(states))
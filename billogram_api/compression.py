@@ -0,0 +1,177 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Gzip transfer compression of request and response bodies"""
+
+import asyncio
+import functools
+import gzip
+import zlib
+
+from billogram_api import exceptions as ex
+
+# bodies at least this large are compressed on the default executor
+OFF_LOOP_SIZE = 256 * 1024
+# compressed bodies expand manyfold, so decompress smaller ones off-loop
+DECOMPRESS_OFF_LOOP_SIZE = 16 * 1024
+# the encodings asked for, and understood in responses
+ACCEPT_ENCODING = 'gzip, deflate'
+# zlib window bits auto-detecting a gzip or zlib header
+_AUTO_WBITS = 32 + zlib.MAX_WBITS
+# zlib window bits of a raw deflate stream, without any header
+_RAW_WBITS = -zlib.MAX_WBITS
+
+
+class CompressionStats:
+    """Counters of the bytes saved by transfer compression
+
+    'response_bytes' and 'request_bytes' are the sizes of the bodies as
+    sent over the network, the 'saved' counters the difference to their
+    uncompressed sizes. Only compressed bodies are counted.
+    """
+    __slots__ = (
+        'responses', 'response_bytes', 'response_bytes_saved',
+        'requests', 'request_bytes', 'request_bytes_saved',
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def add_response(self, wire_size, decoded_size):
+        """Count a compressed response body"""
+        self.responses += 1
+        self.response_bytes += wire_size
+        self.response_bytes_saved += decoded_size - wire_size
+
+    def add_request(self, wire_size, original_size):
+        """Count a compressed request body"""
+        self.requests += 1
+        self.request_bytes += wire_size
+        self.request_bytes_saved += original_size - wire_size
+
+    def snapshot(self):
+        """The counters as a dict"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _check_encoding(encoding):
+    if encoding not in ('gzip', 'x-gzip', 'deflate'):
+        raise ex.ServiceMalfunctioningError(
+            'Billogram API returned unsupported content encoding {}'.format(
+                encoding)
+        )
+
+
+def _malformed():
+    return ex.ServiceMalfunctioningError(
+        'Billogram API returned a malformed compressed body'
+    )
+
+
+def _decoder(encoding, head):
+    """A zlib decoder for a body starting with 'head'
+
+    'deflate' is meant to be zlib wrapped, but some servers send raw
+    deflate streams, told apart by the zlib header check.
+    """
+    if encoding == 'deflate' and not (
+            len(head) >= 2 and head[0] & 0x0f == 8 and
+            (head[0] << 8 | head[1]) % 31 == 0):
+        return zlib.decompressobj(_RAW_WBITS)
+    return zlib.decompressobj(_AUTO_WBITS)
+
+
+def _decompress(body, encoding):
+    decoder = _decoder(encoding, body[:2])
+    try:
+        decoded = decoder.decompress(body) + decoder.flush()
+    except zlib.error:
+        raise _malformed()
+    if not decoder.eof:
+        # truncated
+        raise _malformed()
+    return decoded
+
+
+async def decompress(body, encoding):
+    """Decode a response body compressed with 'encoding'"""
+    _check_encoding(encoding)
+    if len(body) < DECOMPRESS_OFF_LOOP_SIZE:
+        return _decompress(body, encoding)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _decompress, body, encoding)
+
+
+async def compress(data, level=6):
+    """Gzip a request body, always to the same bytes for the same input"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    # a fixed header timestamp keeps the output reproducible, e.g. for
+    # matching recorded requests
+    if len(data) < OFF_LOOP_SIZE:
+        return gzip.compress(data, level, mtime=0)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(gzip.compress, data, level, mtime=0))
+
+
+class StreamDecoder:
+    """Incremental decoder of a compressed response body"""
+    def __init__(self, encoding):
+        _check_encoding(encoding)
+        self._encoding = encoding
+        # created once the first two bytes, telling the format, arrived
+        self._decoder = None
+        self._head = b''
+        self.wire_size = 0
+        self.decoded_size = 0
+
+    def _count(self, decoded):
+        self.decoded_size += len(decoded)
+        return decoded
+
+    def feed(self, chunk):
+        """Decode a received chunk, returns the bytes decoded so far"""
+        self.wire_size += len(chunk)
+        if self._decoder is None:
+            chunk = self._head + chunk
+            if len(chunk) < 2:
+                self._head = chunk
+                return b''
+            self._decoder = _decoder(self._encoding, chunk)
+        try:
+            return self._count(self._decoder.decompress(chunk))
+        except zlib.error:
+            raise _malformed()
+
+    def close(self):
+        """Returns the remaining decoded bytes at the end of the body"""
+        if self._decoder is None:
+            # too short to hold any compressed stream
+            raise _malformed()
+        try:
+            decoded = self._decoder.flush()
+        except zlib.error:
+            raise _malformed()
+        if not self._decoder.eof:
+            raise _malformed()
+        return self._count(decoded)
@@ -0,0 +1,285 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Bulk export of invoice PDFs from the Billogram v2 API"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import os
+
+from billogram_api import exceptions as ex
+from billogram_api.bulk import BulkProgress, bounded_map
+from billogram_api.streaming import CHUNK_SIZE, open_sink
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+class ExportJob:
+    """One PDF document to export"""
+    __slots__ = ('billogram', 'key', 'path', 'params')
+
+    def __init__(self, billogram, key, path, params):
+        self.billogram = billogram
+        self.key = key
+        self.path = path
+        self.params = params
+
+    def __repr__(self):
+        return '<ExportJob {}>'.format(self.key)
+
+
+class ExportReport:
+    """Summary of an export run"""
+    def __init__(self):
+        self.downloaded = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.failed = []
+        self.deferred = []
+
+    def __repr__(self):
+        return (
+            '<ExportReport downloaded={} skipped={} failed={} '
+            'deferred={}>'.format(
+                self.downloaded,
+                self.skipped,
+                len(self.failed),
+                len(self.deferred),
+            )
+        )
+
+
+class _HashingWriter:
+    """Passes data on to 'write' while computing its size and checksum"""
+    __slots__ = ('_write', 'digest', 'size')
+
+    def __init__(self, write):
+        self._write = write
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    async def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        await self._write(data)
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as fileobj:
+        for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class InvoicePdfExporter:
+    """Exports the invoice PDFs of all billograms matched by a query
+
+    Every PDF is written to '<directory>/<billogram id>/<invoice_no>.pdf',
+    or, with 'letters' set, one file per letter sent for the billogram to
+    '<directory>/<billogram id>/letter-<letter_id>.pdf' (which requires
+    fetching the full billogram object first).
+
+    A manifest in JSON lines format records the key, path, size and SHA-256
+    checksum of every file written. Files already in the manifest, or
+    already present from an interrupted run, are skipped, so an export can
+    simply be run again to resume it. With 'verify' set, the checksums of
+    skipped files are checked and mismatching files downloaded again.
+
+    PDFs not yet generated by Billogram are deferred rather than failed,
+    and tried again up to 'max_deferrals' times, 'defer_delay' seconds
+    apart, once everything else is done.
+    """
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+            self,
+            query,
+            directory,
+            concurrency=4,
+            prefetch=1,
+            letters=False,
+            verify=False,
+            max_deferrals=3,
+            defer_delay=30.0,
+            manifest_name=MANIFEST_NAME,
+    ):
+        self._query = query
+        self._directory = os.fspath(directory)
+        self._concurrency = concurrency
+        self._prefetch = prefetch
+        self._letters = letters
+        self._verify = verify
+        self._max_deferrals = max_deferrals
+        self._defer_delay = defer_delay
+        self._manifest_path = os.path.join(self._directory, manifest_name)
+        self._manifest = {}
+        self._manifest_file = None
+        self._manifest_lock = None
+
+    @property
+    def manifest(self):
+        """Manifest entries by key, as read and written so far"""
+        return self._manifest
+
+    async def _jobs(self):
+        async for billogram in self._query.iter_all(prefetch=self._prefetch):
+            billogram_id = await billogram.get_id()
+            if not self._letters:
+                invoice_no = (await billogram.data()).get('invoice_no')
+                yield ExportJob(
+                    billogram,
+                    '{}/{}'.format(billogram_id, invoice_no),
+                    os.path.join(str(billogram_id), '{}.pdf'.format(
+                        invoice_no if invoice_no is not None else 'invoice')),
+                    {'invoice_no': invoice_no} if invoice_no else {},
+                )
+                continue
+            await billogram.refresh()
+            for event in (await billogram.data()).get('events') or []:
+                letter_id = (event.get('data') or {}).get('letter_id')
+                if letter_id:
+                    yield ExportJob(
+                        billogram,
+                        '{}/letter-{}'.format(billogram_id, letter_id),
+                        os.path.join(
+                            str(billogram_id),
+                            'letter-{}.pdf'.format(letter_id)),
+                        {'letter_id': letter_id},
+                    )
+
+    def _load_manifest(self):
+        os.makedirs(self._directory, exist_ok=True)
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as fileobj:
+                for line in fileobj:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash, the file it refers
+                        # to is picked up again below
+                        continue
+                    self._manifest[entry['key']] = entry
+        # pylint: disable=consider-using-with
+        self._manifest_file = open(self._manifest_path, 'a+')
+        if self._manifest_file.tell():
+            self._manifest_file.seek(self._manifest_file.tell() - 1)
+            if self._manifest_file.read(1) != '\n':
+                # terminate a line cut short, so new entries stay readable
+                self._manifest_file.write('\n')
+
+    def _append_manifest(self, entry):
+        self._manifest_file.write(json.dumps(entry) + '\n')
+        self._manifest_file.flush()
+        os.fsync(self._manifest_file.fileno())
+
+    async def _record(self, job, size, sha256):
+        entry = {
+            'key': job.key,
+            'path': job.path,
+            'size': size,
+            'sha256': sha256,
+        }
+        async with self._manifest_lock:
+            self._manifest[job.key] = entry
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._append_manifest, entry)
+
+    async def _already_done(self, job):
+        """Whether the job's file exists and is complete"""
+        loop = asyncio.get_running_loop()
+        path = os.path.join(self._directory, job.path)
+        if not await loop.run_in_executor(None, os.path.exists, path):
+            return False
+        entry = self._manifest.get(job.key)
+        if entry is not None and not self._verify:
+            size = await loop.run_in_executor(None, os.path.getsize, path)
+            return size == entry['size']
+        # files only get their final name once completely written, so one
+        # missing from the manifest is from a run interrupted right after
+        size, sha256 = await loop.run_in_executor(None, _hash_file, path)
+        if entry is not None:
+            return (size, sha256) == (entry['size'], entry['sha256'])
+        await self._record(job, size, sha256)
+        return True
+
+    async def _export(self, job):
+        """Export one PDF, returns the number of bytes written or None"""
+        if await self._already_done(job):
+            return None
+        path = os.path.join(self._directory, job.path)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            functools.partial(
+                os.makedirs, os.path.dirname(path), exist_ok=True))
+        async with open_sink(path) as write:
+            writer = _HashingWriter(write)
+            await job.billogram.save_invoice_pdf(writer, **job.params)
+        await self._record(job, writer.size, writer.digest.hexdigest())
+        return writer.size
+
+    async def _run_jobs(self, jobs, report, progress, totals):
+        deferred = []
+        async for result in bounded_map(jobs, self._export, self._concurrency):
+            if isinstance(result.error, ex.ObjectNotAvailableYetError):
+                deferred.append(result.input)
+                continue
+            totals.add(result)
+            if not result.ok:
+                report.failed.append((result.input.key, result.error))
+            elif result.result is None:
+                report.skipped += 1
+            else:
+                report.downloaded += 1
+                report.bytes += result.result
+            if progress is not None:
+                progress(totals)
+        return deferred
+
+    async def run(self, progress=None):
+        """Export all PDFs, returns an ExportReport
+
+        If 'progress' is given it is called with a BulkProgress after every
+        finished PDF.
+        """
+        loop = asyncio.get_running_loop()
+        self._manifest_lock = asyncio.Lock()
+        await loop.run_in_executor(None, self._load_manifest)
+        report = ExportReport()
+        totals = BulkProgress()
+        try:
+            deferred = await self._run_jobs(
+                self._jobs(), report, progress, totals)
+            for _ in range(self._max_deferrals):
+                if not deferred:
+                    break
+                await asyncio.sleep(self._defer_delay)
+                deferred = await self._run_jobs(
+                    deferred, report, progress, totals)
+            report.deferred = [job.key for job in deferred]
+        finally:
+            await loop.run_in_executor(None, self._manifest_file.close)
+        return report
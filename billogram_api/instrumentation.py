@@ -0,0 +1,225 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Instrumentation of requests made to the Billogram v2 HTTP API"""
+
+import bisect
+import collections
+
+RequestRecord = collections.namedtuple(
+    'RequestRecord',
+    [
+        'method',
+        'url_template',
+        'status',
+        'api_status',
+        'duration',
+        'request_size',
+        'response_size',
+        'error',
+    ],
+)
+RequestRecord.__doc__ = """Details of one HTTP request to the API
+
+'status' is the HTTP status and 'api_status' the status string of the
+response envelope (None when not received), 'duration' is in seconds and
+the sizes are body sizes in bytes. 'error' is the exception class raised
+for the request, or None.
+"""
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+def url_template(obj):
+    """Endpoint template of a request path, without object ids
+
+    For example 'billogram/{id}/command/{event}' for
+    'billogram/ABC123/command/send', so that requests can be grouped by
+    endpoint.
+    """
+    parts = obj.split('/')
+    template = parts[:1]
+    if len(parts) > 1:
+        template.append('{id}.pdf' if parts[1].endswith('.pdf') else '{id}')
+    rest = parts[2:]
+    while rest:
+        part = rest.pop(0)
+        template.append(part)
+        if part == 'command' and rest:
+            rest.pop(0)
+            template.append('{event}')
+    return '/'.join(template)
+
+
+class Instrumentation:
+    """Base class of request instrumentation
+
+    Subclass and override 'on_request', it is called with a RequestRecord
+    after every HTTP request made, including every retry attempt. It runs
+    on the event loop and should return quickly.
+    """
+    def on_request(self, record):
+        """Handle the record of a finished request"""
+
+
+class _EndpointStats:
+    """Aggregated numbers for one method and endpoint"""
+    __slots__ = (
+        'count', 'duration_sum', 'buckets', 'request_bytes',
+        'response_bytes', 'outcomes',
+    )
+
+    def __init__(self, n_buckets):
+        self.count = 0
+        self.duration_sum = 0.0
+        self.buckets = [0] * n_buckets
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.outcomes = collections.Counter()
+
+
+class HistogramCollector(Instrumentation):
+    """Collects request latency histograms and counters in memory
+
+    Numbers are kept per method and endpoint template: a latency histogram
+    with the upper bounds 'buckets' (in seconds), bytes sent and received,
+    and request counts by HTTP status, API status and error class.
+    """
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        self._endpoints = {}
+
+    def on_request(self, record):
+        key = (record.method, record.url_template)
+        stats = self._endpoints.get(key)
+        if stats is None:
+            stats = self._endpoints[key] = _EndpointStats(
+                len(self._buckets))
+        stats.count += 1
+        stats.duration_sum += record.duration
+        index = bisect.bisect_left(self._buckets, record.duration)
+        if index < len(self._buckets):
+            stats.buckets[index] += 1
+        stats.request_bytes += record.request_size or 0
+        stats.response_bytes += record.response_size or 0
+        stats.outcomes[(
+            record.status,
+            record.api_status,
+            record.error and record.error.__name__,
+        )] += 1
+
+    def reset(self):
+        """Forget everything collected so far"""
+        self._endpoints = {}
+
+    def snapshot(self):
+        """Collected numbers as a list of dicts, one per endpoint"""
+        result = []
+        for (method, template), stats in sorted(self._endpoints.items()):
+            cumulative = []
+            total = 0
+            for count in stats.buckets:
+                total += count
+                cumulative.append(total)
+            result.append({
+                'method': method,
+                'url_template': template,
+                'count': stats.count,
+                'duration_sum': stats.duration_sum,
+                'buckets': dict(zip(self._buckets, cumulative)),
+                'request_bytes': stats.request_bytes,
+                'response_bytes': stats.response_bytes,
+                'outcomes': [
+                    {
+                        'status': status,
+                        'api_status': api_status,
+                        'error': error,
+                        'count': count,
+                    }
+                    for (status, api_status, error), count in
+                    stats.outcomes.items()
+                ],
+            })
+        return result
+
+    def to_prometheus(self, prefix='billogram_api'):
+        """Collected numbers in the Prometheus text exposition format"""
+        def labels(**values):
+            return '{' + ','.join(
+                '{}="{}"'.format(
+                    name,
+                    str('' if value is None else value)
+                    .replace('\\', '\\\\').replace('"', '\\"')
+                )
+                for name, value in values.items()
+            ) + '}'
+
+        lines = [
+            '# TYPE {}_request_duration_seconds histogram'.format(prefix),
+        ]
+        snapshot = self.snapshot()
+        for endpoint in snapshot:
+            common = {
+                'method': endpoint['method'],
+                'endpoint': endpoint['url_template'],
+            }
+            for bound, count in endpoint['buckets'].items():
+                lines.append('{}_request_duration_seconds_bucket{} {}'.format(
+                    prefix, labels(le=bound, **common), count))
+            lines.append('{}_request_duration_seconds_bucket{} {}'.format(
+                prefix, labels(le='+Inf', **common), endpoint['count']))
+            lines.append('{}_request_duration_seconds_sum{} {}'.format(
+                prefix, labels(**common), endpoint['duration_sum']))
+            lines.append('{}_request_duration_seconds_count{} {}'.format(
+                prefix, labels(**common), endpoint['count']))
+
+        lines.append('# TYPE {}_requests_total counter'.format(prefix))
+        for endpoint in snapshot:
+            for outcome in endpoint['outcomes']:
+                lines.append('{}_requests_total{} {}'.format(
+                    prefix,
+                    labels(
+                        method=endpoint['method'],
+                        endpoint=endpoint['url_template'],
+                        status=outcome['status'],
+                        api_status=outcome['api_status'],
+                        error=outcome['error'],
+                    ),
+                    outcome['count']
+                ))
+
+        for direction in ('request', 'response'):
+            lines.append('# TYPE {}_{}_bytes_total counter'.format(
+                prefix, direction))
+            for endpoint in snapshot:
+                lines.append('{}_{}_bytes_total{} {}'.format(
+                    prefix,
+                    direction,
+                    labels(
+                        method=endpoint['method'],
+                        endpoint=endpoint['url_template'],
+                    ),
+                    endpoint[direction + '_bytes']
+                ))
+        return '\n'.join(lines) + '\n'
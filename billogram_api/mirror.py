@@ -0,0 +1,305 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Incrementally synchronized local mirror of Billogram API collections"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import sqlite3
+import time
+
+from billogram_api import exceptions as ex
+from billogram_api.bulk import bounded_map
+
+WATERMARK_FIELD = 'updated_at'
+# concurrent requests checking whether objects were removed remotely
+CONFIRM_CONCURRENCY = 10
+
+
+def _json_path(field):
+    """JSON path of a possibly nested field, 'customer:name' style"""
+    return '$.' + '.'.join(
+        '"{}"'.format(part.replace('"', '')) for part in field.split(':'))
+
+
+class LocalMirror:
+    """Local SQLite copy of customers, items and billograms
+
+    'classes' are the collections to mirror (default the customers, items
+    and billogram collections of 'api'), each stored in a table named by
+    its url name with the object data as JSON.
+
+    'sync' only fetches objects changed since the previous sync: it pages
+    through each collection ordered by 'watermark_field' descending and
+    stops at the first object older than the newest one seen last time.
+    Remote deletions are only noticed by a full sync.
+
+    All database access runs on a dedicated thread, so the async read
+    methods never block the event loop.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self,
+            api,
+            path,
+            classes=None,
+            watermark_field=WATERMARK_FIELD,
+            page_size=100,
+            prefetch=1,
+    ):
+        if classes is None:
+            classes = (api.customers, api.items, api.billogram)
+        self._classes = {cls.url_name: cls for cls in classes}
+        self._path = path
+        self._watermark_field = watermark_field
+        self._page_size = page_size
+        self._prefetch = prefetch
+        self._db = None
+        self._executor = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args)
+
+    def _open(self):
+        # pylint: disable=consider-using-with
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sync_state ('
+                'collection TEXT PRIMARY KEY, watermark TEXT, synced_at REAL)'
+            )
+            for name in self._classes:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS "{}" ('
+                    'id TEXT PRIMARY KEY, updated_at TEXT, '
+                    'data TEXT NOT NULL)'.format(name)
+                )
+
+    async def open(self):
+        """Open the database, creating the tables if needed"""
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        await self._run(self._open)
+
+    async def close(self):
+        """Close the database"""
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _table(self, collection):
+        if collection not in self._classes:
+            raise KeyError('Collection {} is not mirrored'.format(collection))
+        return '"{}"'.format(collection)
+
+    def _get_watermark(self, collection):
+        row = self._db.execute(
+            'SELECT watermark FROM sync_state WHERE collection = ?',
+            (collection,)
+        ).fetchone()
+        return row and row[0]
+
+    def _store(self, collection, rows, watermark, stale_ids=None):
+        table = self._table(collection)
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO {} (id, updated_at, data) '
+                'VALUES (?, ?, ?)'.format(table),
+                rows
+            )
+            if stale_ids:
+                self._db.executemany(
+                    'DELETE FROM {} WHERE id = ?'.format(table),
+                    ((i,) for i in stale_ids)
+                )
+            if watermark is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO sync_state '
+                    '(collection, watermark, synced_at) VALUES (?, ?, ?)',
+                    (collection, watermark, time.time())
+                )
+
+    def _ids(self, collection):
+        return {
+            row[0] for row in self._db.execute(
+                'SELECT id FROM {}'.format(self._table(collection)))
+        }
+
+    async def watermark(self, collection):
+        """Newest change timestamp synchronized for the collection"""
+        return await self._run(self._get_watermark, collection)
+
+    async def sync_collection(self, collection, full=False):
+        """Bring one collection up to date, returns the number of objects
+        written
+
+        A 'full' sync fetches every object and also removes objects no
+        longer present remotely. Objects deleted remotely during the sync
+        shift the later pages, so an object not seen is only removed once a
+        request for it confirms it is gone.
+
+        Objects skipped that way would also be left behind by incremental
+        syncs once the watermark passed them, so when the number of objects
+        dropped during the sync the watermark is not advanced, and the next
+        sync walks the same changes again. Like Query.iter_stable, this
+        can't detect deletions offset by as many new objects.
+        """
+        cls = self._classes[collection]
+        field = self._watermark_field
+        since = None if full else await self.watermark(collection)
+        newest = since
+        seen = set()
+        written = 0
+
+        query = cls.query()
+        query.page_size = self._page_size
+        query.order = {'order_field': field, 'order_direction': 'desc'}
+        total = await query.count(use_cache=False)
+        pages = query.iter_pages(prefetch=self._prefetch)
+        try:
+            async for page in pages:
+                rows = []
+                done = False
+                for obj in page:
+                    data = await obj.data()
+                    changed = data.get(field)
+                    if (since is not None and changed is not None and
+                            changed < since):
+                        done = True
+                        break
+                    if changed is not None and (
+                            newest is None or changed > newest):
+                        newest = changed
+                    object_id = str(await obj.get_id())
+                    seen.add(object_id)
+                    rows.append((object_id, changed, json.dumps(data)))
+                # store every page as it arrives, with the watermark only
+                # advanced at the end, an interrupted sync is just redone
+                await self._run(self._store, collection, rows, None)
+                written += len(rows)
+                if done:
+                    break
+        finally:
+            await pages.aclose()
+        if await query.count(use_cache=False) < total:
+            # deletions shifted the pages, changes may have been skipped
+            newest = None
+
+        rows = []
+        stale = []
+        if full:
+            unseen = await self._run(self._ids, collection) - seen
+            results = bounded_map(
+                unseen,
+                functools.partial(self._confirm, cls),
+                CONFIRM_CONCURRENCY,
+            )
+            try:
+                async for result in results:
+                    if not result.ok:
+                        raise result.error
+                    if result.result is None:
+                        stale.append(result.input)
+                        continue
+                    rows.append(result.result)
+            finally:
+                await results.aclose()
+        await self._run(self._store, collection, rows, newest, stale)
+        return written + len(rows)
+
+    async def _confirm(self, cls, object_id):
+        """The row of an object not seen by a full sync, None if it was
+        removed remotely"""
+        try:
+            # bypass any object cache of the class
+            resp = await cls.api.get(await cls.url_of(obj_id=object_id))
+        except ex.ObjectNotFoundError:
+            return None
+        data = resp['data']
+        return (
+            object_id,
+            data.get(self._watermark_field),
+            json.dumps(data),
+        )
+
+    async def sync(self, full=False):
+        """Bring all mirrored collections up to date concurrently
+
+        Returns the number of objects written per collection.
+        """
+        names = list(self._classes)
+        counts = await asyncio.gather(*(
+            self.sync_collection(name, full=full) for name in names))
+        return dict(zip(names, counts))
+
+    def _select(self, collection, where='', args=()):
+        return [
+            json.loads(row[0]) for row in self._db.execute(
+                'SELECT data FROM {} {}'.format(
+                    self._table(collection), where),
+                args
+            )
+        ]
+
+    async def get(self, collection, object_id):
+        """Mirrored data of one object, or None if not present"""
+        found = await self._run(
+            self._select, collection, 'WHERE id = ?', (str(object_id),))
+        return found[0] if found else None
+
+    async def all(self, collection):
+        """Mirrored data of all objects of the collection"""
+        return await self._run(self._select, collection)
+
+    async def find(self, collection, field, value):
+        """Mirrored objects with 'field' equal to 'value'
+
+        Nested fields are given 'customer:customer_no' style, as in API
+        queries.
+        """
+        return await self._run(
+            self._select,
+            collection,
+            'WHERE json_extract(data, ?) = ?',
+            (_json_path(field), value)
+        )
+
+    async def count(self, collection):
+        """Number of mirrored objects in the collection"""
+        def count():
+            return self._db.execute(
+                'SELECT COUNT(*) FROM {}'.format(self._table(collection))
+            ).fetchone()[0]
+        return await self._run(count)
@@ -0,0 +1,255 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Serving many Billogram accounts from one process
+
+A ClientPool hands out BillogramAPI objects per tenant (account) that all
+share one HTTP session and connection pool, authenticating each request
+with the credentials of its tenant.
+"""
+
+import collections
+import time
+
+import aiohttp
+
+from billogram_api.billogram_api import BillogramAPI, create_connector
+from billogram_api.instrumentation import Instrumentation
+from billogram_api.ratelimit import RateLimiter
+from billogram_api.retry import RetryPolicy
+
+
+class TenantStats(Instrumentation):
+    """Request counters of one tenant"""
+    __slots__ = (
+        'requests', 'errors', 'total_duration', 'request_bytes',
+        'response_bytes', 'last_request',
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_duration = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.last_request = None
+
+    def on_request(self, record):
+        self.requests += 1
+        if record.error is not None:
+            self.errors += 1
+        self.total_duration += record.duration
+        self.request_bytes += record.request_size
+        self.response_bytes += record.response_size
+        self.last_request = time.time()
+
+    def snapshot(self):
+        """The counters as a dict"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Tenant:
+    """Registration of a tenant, kept when its client is evicted"""
+    __slots__ = ('options', 'rate_limiter', 'retry_policy', 'stats',
+                 'evictions')
+
+    def __init__(self, options, rate_limiter, retry_policy):
+        self.options = options
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.stats = TenantStats()
+        self.evictions = 0
+
+
+class ClientPool:
+    """Registry of BillogramAPI objects for many accounts
+
+    Register each account with 'add_tenant' and get its API object with
+    'client'. All clients share one aiohttp session over 'connector' (or a
+    connector created from the pool options, see create_connector), created
+    on first use. Other keyword arguments are defaults for the
+    BillogramAPI objects, e.g. 'api_base'.
+
+    Clients not used for 'idle_timeout' seconds are evicted, as is the
+    least recently used one beyond 'max_clients', dropping their object
+    caches. A tenant's rate limiter, retry policy and stats are kept with
+    its registration, so they survive eviction, and the client is created
+    again when next asked for. An evicted client still in use by some task
+    keeps working.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self,
+            connector=None,
+            idle_timeout=300.0,
+            max_clients=None,
+            pool_size=None,
+            pool_size_per_host=None,
+            **options
+    ):
+        self._connector = connector
+        self._connector_owner = connector is None
+        self._connector_options = {
+            k: v for k, v in (
+                ('pool_size', pool_size),
+                ('pool_size_per_host', pool_size_per_host),
+            ) if v is not None
+        }
+        self._idle_timeout = idle_timeout
+        self._max_clients = max_clients
+        self._options = options
+        self._session = None
+        self._tenants = {}
+        # least recently used first, values are (client, last use)
+        self._clients = collections.OrderedDict()
+
+    @property
+    def tenants(self):
+        """Ids of the registered tenants"""
+        return list(self._tenants)
+
+    def __len__(self):
+        """Number of live clients"""
+        return len(self._clients)
+
+    # pylint: disable=too-many-arguments
+    def add_tenant(
+            self,
+            tenant,
+            auth_user,
+            auth_key,
+            user_agent=None,
+            rate_limit=None,
+            max_in_flight=None,
+            rate_limiter=None,
+            retry_policy=None,
+            **options
+    ):
+        """Register the credentials and settings of an account
+
+        'tenant' is any hashable id. The keyword arguments are as for
+        BillogramAPI, overriding the defaults of the pool. Registering a
+        tenant again replaces its settings and evicts its client.
+        """
+        if rate_limiter is None and (rate_limit or max_in_flight):
+            rate_limiter = RateLimiter(
+                rate=rate_limit,
+                max_in_flight=max_in_flight,
+            )
+        options.update(
+            auth_user=auth_user,
+            auth_key=auth_key,
+            user_agent=user_agent,
+        )
+        self._evict(tenant)
+        self._tenants[tenant] = _Tenant(
+            options,
+            rate_limiter,
+            retry_policy or RetryPolicy(),
+        )
+
+    def remove_tenant(self, tenant):
+        """Forget an account and drop its client"""
+        self._evict(tenant)
+        del self._tenants[tenant]
+
+    def _evict(self, tenant):
+        entry = self._clients.pop(tenant, None)
+        if entry is not None:
+            self._tenants[tenant].evictions += 1
+
+    def evict_idle(self):
+        """Drop the clients idle for longer than the idle timeout"""
+        if self._idle_timeout is None:
+            return
+        deadline = time.monotonic() - self._idle_timeout
+        while self._clients:
+            tenant, (_, last_used) = next(iter(self._clients.items()))
+            if last_used > deadline:
+                break
+            self._evict(tenant)
+
+    def _get_session(self):
+        if self._session is None:
+            connector = self._connector or create_connector(
+                **self._connector_options)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                connector_owner=self._connector_owner,
+                auto_decompress=False,
+            )
+        return self._session
+
+    def client(self, tenant):
+        """The BillogramAPI object of a registered tenant"""
+        registration = self._tenants[tenant]
+        self.evict_idle()
+        entry = self._clients.pop(tenant, None)
+        if entry is None:
+            options = dict(self._options, **registration.options)
+            instrumentation = options.pop('instrumentation', ())
+            if isinstance(instrumentation, Instrumentation):
+                instrumentation = (instrumentation,)
+            client = BillogramAPI(
+                session=self._get_session(),
+                rate_limiter=registration.rate_limiter,
+                retry_policy=registration.retry_policy,
+                instrumentation=(registration.stats,) + tuple(instrumentation),
+                **options
+            )
+        else:
+            client = entry[0]
+        self._clients[tenant] = (client, time.monotonic())
+        if (self._max_clients is not None and
+                len(self._clients) > self._max_clients):
+            self._evict(next(iter(self._clients)))
+        return client
+
+    def __getitem__(self, tenant):
+        return self.client(tenant)
+
+    def stats(self, tenant):
+        """Request counters, rate limiter and retry statistics of a tenant"""
+        registration = self._tenants[tenant]
+        return {
+            'requests': registration.stats.snapshot(),
+            'rate_limiter': (
+                registration.rate_limiter and
+                registration.rate_limiter.stats()
+            ),
+            'retries': registration.retry_policy.stats(),
+            'evictions': registration.evictions,
+            'live': tenant in self._clients,
+        }
+
+    async def close(self):
+        """Drop all clients and close the shared session"""
+        self._clients.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -0,0 +1,197 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Client side request throttling for the Billogram v2 HTTP API"""
+
+import asyncio
+import contextlib
+import time
+
+
+class RateLimiter:
+    """Adaptive token bucket rate limiter with a cap on requests in flight
+
+    'rate' is the number of requests per second allowed on average, with
+    bursts of up to 'burst' requests (defaults to one second worth of
+    requests). 'max_in_flight' caps the number of requests awaiting a
+    response. Either limit can be None to disable it.
+
+    When the service reports errors the allowed rate is multiplied by
+    'backoff_factor' (at most once per 'backoff_interval' seconds, and never
+    below 'min_rate'), after which it recovers linearly back to 'rate' over
+    'recovery_time' seconds.
+
+    One limiter can be shared by several BillogramAPI objects to throttle
+    them together.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(
+            self,
+            rate=None,
+            burst=None,
+            max_in_flight=None,
+            min_rate=None,
+            backoff_factor=0.5,
+            backoff_interval=1.0,
+            recovery_time=30.0,
+    ):
+        assert rate is None or rate > 0
+        assert max_in_flight is None or max_in_flight >= 1
+        assert 0 < backoff_factor < 1
+        self._max_rate = rate
+        self._min_rate = min_rate or (rate and rate / 20)
+        self._burst = burst or (rate and max(1.0, float(rate)))
+        self._backoff_factor = backoff_factor
+        self._backoff_interval = backoff_interval
+        self._recovery_time = recovery_time
+        self._max_in_flight = max_in_flight
+
+        self._tokens = self._burst
+        self._last_refill = time.monotonic()
+        self._reduced_rate = rate
+        self._last_backoff = None
+        # created on first use, so they bind to the loop actually running
+        self._lock = None
+        self._semaphore = None
+
+        self._waiting = 0
+        self._in_flight = 0
+        self._acquired = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._backoffs = 0
+
+    @property
+    def rate(self):
+        """Currently allowed requests per second, None if unlimited"""
+        if self._max_rate is None:
+            return None
+        if self._last_backoff is None or not self._recovery_time:
+            return self._reduced_rate
+        elapsed = time.monotonic() - self._last_backoff
+        if elapsed >= self._recovery_time:
+            return self._max_rate
+        return self._reduced_rate + (
+            (self._max_rate - self._reduced_rate) *
+            elapsed / self._recovery_time
+        )
+
+    @property
+    def waiting(self):
+        """Number of requests currently queued waiting for the limiter"""
+        return self._waiting
+
+    @property
+    def in_flight(self):
+        """Number of requests currently let through and not yet finished"""
+        return self._in_flight
+
+    def stats(self):
+        """Snapshot of the limiter state and its wait time statistics"""
+        return {
+            'rate': self.rate,
+            'waiting': self._waiting,
+            'in_flight': self._in_flight,
+            'acquired': self._acquired,
+            'total_wait': self._total_wait,
+            'mean_wait': self._acquired and self._total_wait / self._acquired,
+            'max_wait': self._max_wait,
+            'backoffs': self._backoffs,
+        }
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.rate
+        self._tokens = min(
+            self._burst,
+            self._tokens + (now - self._last_refill) * rate
+        )
+        self._last_refill = now
+        return rate
+
+    async def _take_token(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # the lock makes waiters take tokens in arrival order
+        async with self._lock:
+            while True:
+                rate = self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / rate)
+
+    async def acquire(self):
+        """Wait until a request may be sent, pair with a call to release"""
+        start = time.monotonic()
+        self._waiting += 1
+        try:
+            if self._max_in_flight is not None:
+                if self._semaphore is None:
+                    self._semaphore = asyncio.Semaphore(self._max_in_flight)
+                await self._semaphore.acquire()
+            try:
+                if self._max_rate is not None:
+                    await self._take_token()
+            except BaseException:
+                if self._semaphore is not None:
+                    self._semaphore.release()
+                raise
+        finally:
+            self._waiting -= 1
+        waited = time.monotonic() - start
+        self._in_flight += 1
+        self._acquired += 1
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+
+    def release(self):
+        """Mark a request let through by acquire as finished"""
+        self._in_flight -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Async context manager holding the limiter for one request"""
+        await self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def backoff(self):
+        """Lower the allowed rate after the service reported an error"""
+        if self._max_rate is None:
+            return
+        now = time.monotonic()
+        if (self._last_backoff is not None and
+                now - self._last_backoff < self._backoff_interval):
+            # a burst of failures counts as a single signal
+            return
+        self._reduced_rate = max(
+            self._min_rate,
+            self.rate * self._backoff_factor
+        )
+        self._last_backoff = now
+        self._backoffs += 1
+        self._tokens = min(self._tokens, 1.0)
@@ -0,0 +1,175 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Retrying of failed requests to the Billogram v2 HTTP API"""
+
+import asyncio
+import collections
+import random
+import time
+
+import aiohttp
+
+from billogram_api import exceptions as ex
+
+# errors that say nothing about the request itself, so sending it again
+# may well succeed
+TRANSIENT_ERRORS = (
+    ex.ServiceMalfunctioningError,
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError,
+)
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE'))
+
+AttemptRecord = collections.namedtuple(
+    'AttemptRecord',
+    ['method', 'obj', 'attempt', 'duration', 'error'],
+)
+
+
+class RetryBudget:
+    """Limits retries to a fraction of the requests made
+
+    Every request deposits 'ratio' retry tokens, up to 'max_tokens', and
+    every retry withdraws one. When the budget is exhausted failures are
+    raised right away, so retries can't multiply the load on a service
+    that is already struggling.
+    """
+    def __init__(self, ratio=0.2, max_tokens=20.0):
+        self._ratio = ratio
+        self._max_tokens = max_tokens
+        self._tokens = max_tokens
+
+    @property
+    def tokens(self):
+        """Number of retries currently available"""
+        return self._tokens
+
+    def deposit(self):
+        """Account for a request being made"""
+        self._tokens = min(self._max_tokens, self._tokens + self._ratio)
+
+    def withdraw(self):
+        """Try to take a retry from the budget, returns False if empty"""
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    """Decides which failed requests are retried and how long to wait
+
+    Requests failing with a transient error (server errors, connection
+    errors and timeouts) are attempted up to 'max_attempts' times in total.
+    Requests with an idempotent method are always eligible, POST requests
+    only when the caller marks them as safe to repeat.
+
+    Before each retry the policy sleeps a random time between zero and
+    backoff_base * 2 ** (attempt - 1), capped by 'backoff_max' ("full
+    jitter"), and takes a token from the 'budget' shared by all calls.
+
+    The latest 'history_size' attempts are kept as AttemptRecord tuples
+    in 'history', and 'stats' sums up how much time went to retrying.
+    """
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+            self,
+            max_attempts=3,
+            backoff_base=0.2,
+            backoff_max=5.0,
+            budget=None,
+            retry_methods=IDEMPOTENT_METHODS,
+            history_size=1000,
+    ):
+        assert max_attempts >= 1
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.budget = budget or RetryBudget()
+        self.retry_methods = frozenset(retry_methods)
+        self.history = collections.deque(maxlen=history_size)
+
+        self._calls = 0
+        self._attempts = 0
+        self._retries = 0
+        self._exhausted = 0
+        self._failed_attempt_time = 0.0
+        self._backoff_time = 0.0
+
+    def stats(self):
+        """Counters and the time spent on failed attempts and backoff"""
+        return {
+            'calls': self._calls,
+            'attempts': self._attempts,
+            'retries': self._retries,
+            'budget_exhausted': self._exhausted,
+            'failed_attempt_time': self._failed_attempt_time,
+            'backoff_time': self._backoff_time,
+            'budget_tokens': self.budget.tokens,
+        }
+
+    def is_retryable(self, method, error, retry_safe=False):
+        """Whether a request failing with 'error' may be sent again"""
+        if not isinstance(error, TRANSIENT_ERRORS):
+            return False
+        return retry_safe or method.upper() in self.retry_methods
+
+    def backoff(self, attempt):
+        """Seconds to wait before the attempt following 'attempt'"""
+        return random.uniform(
+            0,
+            min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        )
+
+    # pylint: disable=too-many-arguments
+    async def call(self, method, obj, send, retry_safe=False):
+        """Run the coroutine function 'send' until done or out of retries"""
+        self._calls += 1
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            self._attempts += 1
+            start = time.monotonic()
+            try:
+                result = await send()
+            except Exception as err:  # pylint: disable=broad-except
+                duration = time.monotonic() - start
+                self.history.append(AttemptRecord(
+                    method, obj, attempt, duration, type(err).__name__))
+                self._failed_attempt_time += duration
+                if (attempt >= self.max_attempts or
+                        not self.is_retryable(method, err, retry_safe)):
+                    raise
+                if not self.budget.withdraw():
+                    self._exhausted += 1
+                    raise
+                self._retries += 1
+                delay = self.backoff(attempt)
+                self._backoff_time += delay
+                await asyncio.sleep(delay)
+                continue
+            self.history.append(AttemptRecord(
+                method, obj, attempt, time.monotonic() - start, None))
+            return result
@@ -0,0 +1,239 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Streaming of large base64 encoded documents to and from the API"""
+
+import asyncio
+import binascii
+import contextlib
+import functools
+import inspect
+import json
+import os
+import re
+
+from billogram_api import exceptions as ex
+
+CHUNK_SIZE = 64 * 1024
+# raw bytes encoded at a time, a multiple of 3 so that the pieces of
+# base64 can be concatenated without padding in between
+ENCODE_CHUNK_SIZE = 3 * CHUNK_SIZE
+
+
+class Base64FieldExtractor:
+    """Incrementally decodes a base64 string field out of a JSON document
+
+    Feed the raw JSON body in chunks of any size. The value of the first
+    string field named 'field' is decoded on the fly and returned from
+    'feed' in pieces, the rest of the document is kept, with the field
+    value replaced by an empty string, and returned by 'close' for regular
+    parsing. Memory use is bounded by the chunk size, not the document.
+    """
+    # longest tail that may hold an incomplete '"field" :  "' match
+    _MAX_KEY_TAIL = 64
+
+    def __init__(self, field='content'):
+        self._key = re.compile(
+            rb'"' + re.escape(field.encode('ascii')) + rb'"\s*:\s*"')
+        self._state = 'key'
+        self._pending = b''
+        self._envelope = []
+        self._found = False
+        self._escaped = False
+
+    def _decode(self, final=False):
+        usable = len(self._pending) if final else len(self._pending) & ~3
+        if not usable:
+            return b''
+        try:
+            decoded = binascii.a2b_base64(self._pending[:usable])
+        except binascii.Error:
+            raise ex.ServiceMalfunctioningError(
+                'Billogram API returned malformed base64 content'
+            )
+        self._pending = self._pending[usable:]
+        return decoded
+
+    def _unescape(self, value):
+        # base64 has no characters needing escapes, but JSON encoders may
+        # still escape the slash or wrap lines, and a chunk may end in the
+        # middle of an escape sequence
+        if self._escaped:
+            value = b'\\' + value
+            self._escaped = False
+        trailing = len(value) - len(value.rstrip(b'\\'))
+        if trailing % 2:
+            value = value[:-1]
+            self._escaped = True
+        return (value.replace(b'\\/', b'/')
+                .replace(b'\\n', b'').replace(b'\\r', b''))
+
+    def _feed_value(self, chunk):
+        end = chunk.find(b'"')
+        value = chunk if end < 0 else chunk[:end]
+        if self._escaped or b'\\' in value:
+            value = self._unescape(value)
+        self._pending += value
+        if end < 0:
+            return self._decode(), b''
+        self._state = 'rest'
+        self._envelope.append(b'"')
+        return self._decode(final=True), chunk[end + 1:]
+
+    def feed(self, chunk):
+        """Process the next chunk of the body, returns decoded bytes"""
+        decoded = b''
+        while chunk:
+            if self._state == 'rest':
+                self._envelope.append(chunk)
+                break
+            if self._state == 'value':
+                part, chunk = self._feed_value(chunk)
+                decoded += part
+                continue
+            data = self._pending + chunk
+            self._pending = b''
+            match = self._key.search(data)
+            if match is None:
+                keep = min(len(data), self._MAX_KEY_TAIL)
+                self._envelope.append(data[:len(data) - keep])
+                self._pending = data[len(data) - keep:]
+                break
+            self._envelope.append(data[:match.end()])
+            self._found = True
+            self._state = 'value'
+            chunk = data[match.end():]
+        return decoded
+
+    def close(self):
+        """Finish the body, returns the JSON document without the field"""
+        if self._state == 'key':
+            self._envelope.append(self._pending)
+            self._pending = b''
+        elif self._state == 'value':
+            raise ex.ServiceMalfunctioningError(
+                'Billogram API response ended inside the content'
+            )
+        return b''.join(self._envelope)
+
+    @property
+    def found(self):
+        """Whether the field was present in the document"""
+        return self._found
+
+
+@contextlib.asynccontextmanager
+async def open_sink(target):
+    """Async context manager giving a coroutine function writing to 'target'
+
+    'target' is a file path, or an object with a regular or a coroutine
+    'write' method. Files are written off the event loop to a temporary
+    name, and only renamed into place when the block finishes without
+    errors.
+    """
+    if not isinstance(target, (str, bytes, os.PathLike)):
+        async def write_to(data):
+            result = target.write(data)
+            if inspect.isawaitable(result):
+                await result
+        yield write_to
+        return
+
+    loop = asyncio.get_running_loop()
+    path = os.fspath(target)
+    partial = path + ('.part' if isinstance(path, str) else b'.part')
+    fileobj = await loop.run_in_executor(None, open, partial, 'wb')
+
+    async def write_file(data):
+        await loop.run_in_executor(None, fileobj.write, data)
+
+    try:
+        yield write_file
+    except BaseException:
+        await loop.run_in_executor(None, fileobj.close)
+        await loop.run_in_executor(None, os.remove, partial)
+        raise
+    await loop.run_in_executor(None, fileobj.close)
+    await loop.run_in_executor(None, os.replace, partial, path)
+
+
+async def read_chunks(source, chunk_size=CHUNK_SIZE):
+    """Read 'source' in chunks without blocking the event loop
+
+    'source' is a file path, a bytes-like object, a binary file object or
+    an object with a coroutine 'read' method.
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+        return
+
+    if isinstance(source, (str, os.PathLike)):
+        fileobj = await loop.run_in_executor(None, open, source, 'rb')
+        try:
+            async for chunk in read_chunks(fileobj, chunk_size):
+                yield chunk
+        finally:
+            await loop.run_in_executor(None, fileobj.close)
+        return
+
+    while True:
+        if inspect.iscoroutinefunction(source.read):
+            chunk = await source.read(chunk_size)
+        else:
+            chunk = await loop.run_in_executor(None, source.read, chunk_size)
+        if not chunk:
+            return
+        if isinstance(chunk, str):
+            raise TypeError('PDF content must be read in binary mode')
+        yield chunk
+
+
+async def iter_base64_json_body(source, fields, field='content'):
+    """Produce a JSON object with 'source' base64 encoded into 'field'
+
+    The other members of the object are taken from the dict 'fields'. The
+    document is produced incrementally as bytes, reading and encoding the
+    source in chunks off the event loop, so it can be streamed as a request
+    body without ever holding the whole encoded document in memory.
+    """
+    loop = asyncio.get_running_loop()
+    members = {k: v for k, v in fields.items() if k != field}
+    members[field] = ''
+    head = json.dumps(members)
+    # the field is last in the dumped object, cut at its empty value
+    yield head[:-3].encode('utf-8') + b'"'
+
+    leftover = b''
+    async for chunk in read_chunks(source, ENCODE_CHUNK_SIZE):
+        data = leftover + bytes(chunk)
+        usable = len(data) - len(data) % 3
+        leftover = data[usable:]
+        if usable:
+            yield await loop.run_in_executor(
+                None, functools.partial(
+                    binascii.b2a_base64, data[:usable], newline=False))
+    if leftover:
+        yield binascii.b2a_base64(leftover, newline=False)
+    yield b'"}'
@@ -0,0 +1,273 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Synchronous facade over the asyncio Billogram v2 API client
+
+All requests run on a single long-lived event loop in a background thread
+shared by the whole process, so one SyncBillogramAPI object (and with it
+its HTTP session and connection pool) can be used from any number of
+threads, e.g. by all the workers of a WSGI server, keeping connections
+alive between calls.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+from billogram_api.billogram_api import (
+    BillogramAPI,
+    BillogramObject,
+    Query,
+    SimpleClass,
+    SimpleObject,
+    SingletonObject,
+)
+from billogram_api.bulk import BulkResult
+
+
+class _LoopThread:
+    """An event loop running forever in a daemon thread"""
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='billogram-api-loop',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @classmethod
+    def get(cls):
+        """The loop thread of this process, started on first use"""
+        with cls._lock:
+            # a forked child inherits the object but not the thread
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def run(self, awaitable, timeout=None):
+        """Run 'awaitable' on the loop, blocking until it is done"""
+        if threading.get_ident() == self._thread.ident:
+            raise RuntimeError(
+                'Synchronous Billogram API called from its own event loop'
+            )
+
+        async def wrapper():
+            return await awaitable
+        future = asyncio.run_coroutine_threadsafe(wrapper(), self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+        except BaseException:
+            # e.g. KeyboardInterrupt in the calling thread
+            future.cancel()
+            raise
+
+
+class _SyncProxy:
+    """Forwards attribute access to an object of the asyncio API
+
+    Coroutines returned by its methods are run to completion on the loop
+    thread, async iterators are turned into iterators, and API objects in
+    the results are wrapped in their synchronous counterparts.
+    """
+    def __init__(self, target, runner, timeout):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_runner', runner)
+        object.__setattr__(self, '_timeout', timeout)
+
+    def _run(self, awaitable):
+        return self._runner.run(awaitable, self._timeout)
+
+    def _wrap(self, value):
+        for async_class, sync_class in _WRAPPERS:
+            if isinstance(value, async_class):
+                return sync_class(value, self._runner, self._timeout)
+        if isinstance(value, BulkResult):
+            return BulkResult(
+                value.index,
+                value.input,
+                self._wrap(value.result),
+                value.error,
+            )
+        if type(value) in (list, tuple):
+            return type(value)(self._wrap(v) for v in value)
+        return value
+
+    def _unwrap(self, value):
+        if isinstance(value, _SyncProxy):
+            return value._target
+        return value
+
+    def _iterate(self, iterator, batch_size=1):
+        """Iterate an async iterator, pulling 'batch_size' items at a time
+
+        The async side only advances when the caller asks for the next
+        batch, so a slow consumer holds back the requests.
+        """
+        async def take_next():
+            batch = []
+            try:
+                while len(batch) < batch_size:
+                    batch.append(await iterator.__anext__())
+            except StopAsyncIteration:
+                return batch, True
+            return batch, False
+
+        try:
+            while True:
+                batch, done = self._run(take_next())
+                for item in batch:
+                    yield self._wrap(item)
+                if done:
+                    return
+        finally:
+            if hasattr(iterator, 'aclose'):
+                self._run(iterator.aclose())
+
+    def _call(self, method, args, kwargs):
+        result = method(
+            *(self._unwrap(a) for a in args),
+            **{k: self._unwrap(v) for k, v in kwargs.items()}
+        )
+        if asyncio.iscoroutine(result):
+            return self._wrap(self._run(result))
+        if hasattr(result, '__aiter__'):
+            return self._iterate(result)
+        return self._wrap(result)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value) or isinstance(value, type):
+            return self._wrap(value)
+
+        def method(*args, **kwargs):
+            return self._call(value, args, kwargs)
+        method.__name__ = name
+        method.__doc__ = value.__doc__
+        return method
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, self._unwrap(value))
+
+    def __eq__(self, other):
+        return self._target == self._unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __repr__(self):
+        return '<sync {!r}>'.format(self._target)
+
+
+class SyncSingletonObject(_SyncProxy):
+    """Synchronous counterpart of SingletonObject"""
+
+
+class SyncSimpleObject(SyncSingletonObject):
+    """Synchronous counterpart of SimpleObject"""
+
+
+class SyncBillogramObject(SyncSimpleObject):
+    """Synchronous counterpart of BillogramObject"""
+
+
+class SyncSimpleClass(_SyncProxy):
+    """Synchronous counterpart of SimpleClass and BillogramClass"""
+
+
+class SyncQuery(_SyncProxy):
+    """Synchronous counterpart of Query and BillogramQuery
+
+    The iterating methods take a 'batch_size', the number of items pulled
+    from the loop thread at a time, defaulting to a page for iter_all and
+    iter_stable. The next batch is only requested once the previous one is
+    consumed, with 'prefetch' bounding the pages fetched ahead of that.
+    """
+    def iter_pages(self, prefetch=0, batch_size=1):
+        """Iterate over all pages of the query, see Query.iter_pages"""
+        return self._iterate(self._target.iter_pages(prefetch), batch_size)
+
+    def iter_all(self, prefetch=0, batch_size=None):
+        """Iterate over all objects of the query, see Query.iter_all"""
+        return self._iterate(
+            self._target.iter_all(prefetch),
+            batch_size or self._target.page_size,
+        )
+
+    def iter_stable(self, *args, batch_size=None, **kwargs):
+        """Iterate over all objects without duplicates, see
+        Query.iter_stable"""
+        return self._iterate(
+            self._target.iter_stable(*args, **kwargs),
+            batch_size or self._target.page_size,
+        )
+
+
+_WRAPPERS = (
+    (BillogramObject, SyncBillogramObject),
+    (SimpleObject, SyncSimpleObject),
+    (SingletonObject, SyncSingletonObject),
+    (Query, SyncQuery),
+    (SimpleClass, SyncSimpleClass),
+)
+
+
+class SyncBillogramAPI(_SyncProxy):
+    """Synchronous counterpart of BillogramAPI
+
+    Takes the same arguments as BillogramAPI, plus a 'timeout' in seconds
+    for every call, which is cancelled on the loop thread when exceeded.
+    Create one object per process and share it between threads, calls from
+    different threads are executed concurrently on the loop thread.
+
+    Must not be called from coroutines running on the loop thread itself,
+    e.g. from Instrumentation callbacks.
+    """
+    def __init__(self, *args, timeout=None, **kwargs):
+        runner = _LoopThread.get()
+
+        async def create():
+            # constructed on the loop thread, where it is used
+            return BillogramAPI(*args, **kwargs)
+        super().__init__(runner.run(create()), runner, timeout)
+
+    def close(self):
+        """Close HTTP session"""
+        self._run(self._target.close())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
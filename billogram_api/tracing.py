@@ -0,0 +1,174 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Lightweight tracing of operations on the Billogram v2 HTTP API"""
+
+import contextlib
+import contextvars
+import json
+import os
+import time
+
+_current_span = contextvars.ContextVar('billogram_api_span', default=None)
+
+
+def current_span():
+    """The span active in the current context, or None"""
+    return _current_span.get()
+
+
+class Span:
+    """A timed operation, part of a trace
+
+    Spans started while another is active in the same context become its
+    children and share its trace id.
+    """
+    __slots__ = (
+        'name', 'trace_id', 'span_id', 'parent_id', 'attributes',
+        'start_time', 'duration', 'error', '_started',
+    )
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes or {}
+        self.start_time = time.time()
+        self.duration = None
+        self.error = None
+        self._started = time.monotonic()
+
+    def finish(self):
+        """Mark the span as ended now"""
+        self.duration = time.monotonic() - self._started
+
+    def to_dict(self):
+        """The span as a JSON serializable dict"""
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration': self.duration,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+    def __repr__(self):
+        return '<Span {} {}/{}>'.format(
+            self.name, self.trace_id, self.span_id)
+
+
+class SpanExporter:
+    """Base class of span exporters, override 'export'"""
+    def export(self, span):
+        """Handle a finished span"""
+
+
+class JsonLinesExporter(SpanExporter):
+    """Writes finished spans as JSON lines to a file path or file object
+
+    Writes are buffered, call 'flush' or 'close' to be sure all spans
+    reached the file.
+    """
+    def __init__(self, target):
+        if isinstance(target, (str, os.PathLike)):
+            # pylint: disable=consider-using-with
+            self._file = open(target, 'a')
+            self._owned = True
+        else:
+            self._file = target
+            self._owned = False
+
+    def export(self, span):
+        self._file.write(json.dumps(span.to_dict(), default=str) + '\n')
+
+    def flush(self):
+        """Flush buffered spans to the file"""
+        self._file.flush()
+
+    def close(self):
+        """Flush and close the file, if opened by the exporter"""
+        self.flush()
+        if self._owned:
+            self._file.close()
+
+
+class Tracer:
+    """Creates spans and hands finished ones to an exporter"""
+    def __init__(self, exporter):
+        self._exporter = exporter
+
+    def start_span(self, name, **attributes):
+        """Start a span under the current one, without making it current"""
+        return Span(name, _current_span.get(), attributes)
+
+    def finish_span(self, span, error=None):
+        """End a span from start_span and export it"""
+        span.finish()
+        if error is not None:
+            span.error = type(error).__name__
+        self._exporter.export(span)
+
+    @contextlib.asynccontextmanager
+    async def span(self, name, **attributes):
+        """Async context manager running its block in a new current span"""
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            _current_span.reset(token)
+            self.finish_span(span, error)
+
+    @staticmethod
+    async def activate(span, awaitable):
+        """Await 'awaitable' with 'span' as the current span
+
+        Useful for work done on behalf of a span that is not current, e.g.
+        in tasks started from an async generator.
+        """
+        token = _current_span.set(span)
+        try:
+            return await awaitable
+        finally:
+            _current_span.reset(token)
+
+
+class _NoSpan:
+    """Stand-in for Tracer.span when tracing is disabled"""
+    __slots__ = ()
+
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NO_SPAN = _NoSpan()
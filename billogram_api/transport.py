@@ -0,0 +1,330 @@
+# encoding=utf-8
+#
+# Based on billogram_api created by Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""HTTP transports for the Billogram API, including record and replay
+
+A transport performs the actual HTTP requests of a BillogramAPI object.
+Besides the regular one using the aiohttp session, requests and responses
+can be recorded to a cassette file and replayed from it later without
+any network access, e.g. for load testing an application against a
+recorded production traffic pattern.
+
+The methods of a transport are passed the aiohttp session of the API
+object, created on demand, if the transport is a SessionTransport, and
+None otherwise.
+"""
+
+import asyncio
+import base64
+import collections
+import contextlib
+import gzip
+import hashlib
+import json
+import time
+import urllib.parse
+
+
+class SessionTransport:
+    """Sends requests over the aiohttp session of the API object"""
+
+    # pylint: disable=too-many-arguments
+    async def request(
+            self, session, method, url, params=None, data=None, headers=None):
+        """Perform a request, returns the response and its body as bytes"""
+        async with session.request(
+                method=method,
+                url=url,
+                params=params,
+                data=data,
+                headers=headers,
+        ) as response:
+            body = await response.read()
+        return response, body
+
+    @contextlib.asynccontextmanager
+    async def stream(self, session, url, params=None, headers=None):
+        """Async context manager performing a GET request, giving a response
+        whose body is read from 'content'"""
+        async with session.get(
+                url,
+                params=params,
+                headers=headers,
+        ) as response:
+            yield response
+
+    async def close(self):
+        """Release resources held by the transport"""
+
+
+class CassetteMissError(KeyError):
+    """No recorded response matches the request being replayed"""
+
+
+def _request_key(method, url, params, body_hash):
+    return (
+        method.upper(),
+        urllib.parse.urlsplit(str(url)).path,
+        tuple(sorted((str(k), str(v)) for k, v in (params or {}).items())),
+        body_hash,
+    )
+
+
+def _hash_body(data):
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class ReplayedResponse:
+    """A recorded response, with the attributes the API object uses"""
+    __slots__ = ('status', 'content_type', 'charset', 'headers', 'body')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, status, content_type, charset, body,
+                 content_encoding=None):
+        self.status = status
+        self.content_type = content_type
+        self.charset = charset
+        self.headers = {}
+        if content_encoding:
+            self.headers['Content-Encoding'] = content_encoding
+        self.body = body
+
+    @property
+    def ok(self):
+        """Whether the status is a success"""
+        return self.status < 400
+
+    @property
+    def content(self):
+        """Stream interface to the body, as for aiohttp responses"""
+        return self
+
+    async def read(self):
+        """The whole body"""
+        return self.body
+
+    async def iter_chunked(self, size):
+        """The body in chunks of 'size' bytes"""
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+
+class _RecordingStream:
+    """Passes a streamed response on while keeping a copy of its body"""
+    def __init__(self, response):
+        self._response = response
+        self.status = response.status
+        self.content_type = response.content_type
+        self.charset = response.charset
+        self.headers = response.headers
+        self.ok = response.ok
+        self.chunks = []
+
+    @property
+    def content(self):
+        """Stream interface to the body"""
+        return self
+
+    async def read(self):
+        """The whole body"""
+        body = await self._response.read()
+        self.chunks.append(body)
+        return body
+
+    async def iter_chunked(self, size):
+        """The body in chunks of at most 'size' bytes"""
+        async for chunk in self._response.content.iter_chunked(size):
+            self.chunks.append(chunk)
+            yield chunk
+
+
+class RecordingTransport(SessionTransport):
+    """Sends requests over the session and records them to a cassette
+
+    The cassette is a gzip compressed JSON lines file, appended to if it
+    exists. With 'match_body' unset, request bodies are not recorded for
+    matching, see ReplayTransport. Streamed downloads are held in memory
+    while recording. Call 'close' (done by BillogramAPI.close) to finish
+    the file.
+    """
+    def __init__(self, path, match_body=True):
+        self._path = path
+        self._match_body = match_body
+        # pylint: disable=consider-using-with
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._started = time.monotonic()
+
+    async def _body_hash(self, data):
+        if not self._match_body or data is None:
+            return None, data
+        if hasattr(data, '__aiter__'):
+            # record the streamed body as it is sent
+            digest = hashlib.sha1()
+
+            async def hashed(chunks):
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    yield chunk
+            return digest, hashed(data)
+        return _hash_body(data), data
+
+    # pylint: disable=too-many-arguments
+    def _record(self, method, url, params, body_hash, started, response,
+                body):
+        try:
+            text, encoding = body.decode('utf-8'), None
+        except UnicodeDecodeError:
+            text, encoding = base64.b64encode(body).decode('ascii'), 'base64'
+        if body_hash is not None and not isinstance(body_hash, str):
+            body_hash = body_hash.hexdigest()
+        self._file.write(json.dumps({
+            'key': _request_key(method, url, params, body_hash),
+            'at': started - self._started,
+            'duration': time.monotonic() - started,
+            'status': response.status,
+            'content_type': response.content_type,
+            'charset': response.charset,
+            'content_encoding': response.headers.get('Content-Encoding'),
+            'encoding': encoding,
+            'body': text,
+        }, separators=(',', ':')) + '\n')
+
+    # pylint: disable=too-many-arguments
+    async def request(
+            self, session, method, url, params=None, data=None, headers=None):
+        started = time.monotonic()
+        body_hash, data = await self._body_hash(data)
+        response, body = await super().request(
+            session, method, url, params, data, headers)
+        self._record(method, url, params, body_hash, started, response, body)
+        return response, body
+
+    @contextlib.asynccontextmanager
+    async def stream(self, session, url, params=None, headers=None):
+        started = time.monotonic()
+        async with super().stream(
+                session, url, params, headers) as response:
+            recording = _RecordingStream(response)
+            yield recording
+        self._record('GET', url, params, None, started, recording,
+                     b''.join(recording.chunks))
+
+    async def close(self):
+        self._file.close()
+
+
+class ReplayTransport:
+    """Answers requests from a cassette file, without network access
+
+    Requests are matched on method, URL path, query parameters and (with
+    'match_body') a hash of the request body. Responses recorded for the
+    same request are replayed in recorded order, and from the start again
+    once used up when 'cycle' is set, otherwise a CassetteMissError is
+    raised, as for requests never recorded.
+
+    With 'latency' set to 'original' every response is delayed by its
+    recorded duration, divided by 'speed', otherwise responses are given
+    right away.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, path, latency='none', speed=1.0, cycle=True,
+                 match_body=True):
+        assert latency in ('none', 'original')
+        self._latency = latency == 'original'
+        self._speed = speed
+        self._cycle = cycle
+        self._match_body = match_body
+        self._recorded = collections.defaultdict(list)
+        self._position = collections.Counter()
+        with gzip.open(path, 'rt', encoding='utf-8') as fileobj:
+            for line in fileobj:
+                entry = json.loads(line)
+                method, path_, params, body_hash = entry['key']
+                if not match_body:
+                    body_hash = None
+                body = entry['body']
+                if entry['encoding'] == 'base64':
+                    body = base64.b64decode(body)
+                else:
+                    body = body.encode('utf-8')
+                key = (method, path_, tuple(map(tuple, params)), body_hash)
+                self._recorded[key].append((
+                    ReplayedResponse(
+                        entry['status'],
+                        entry['content_type'],
+                        entry['charset'],
+                        body,
+                        entry.get('content_encoding'),
+                    ),
+                    entry['duration'],
+                ))
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(len(r) for r in self._recorded.values())
+
+    async def _body_hash(self, data):
+        if not self._match_body or data is None:
+            return None
+        if hasattr(data, '__aiter__'):
+            digest = hashlib.sha1()
+            async for chunk in data:
+                digest.update(chunk)
+            return digest.hexdigest()
+        return _hash_body(data)
+
+    async def _replay(self, method, url, params, data):
+        key = _request_key(method, url, params, await self._body_hash(data))
+        recorded = self._recorded.get(key)
+        position = self._position[key]
+        if recorded and position >= len(recorded) and self._cycle:
+            position = 0
+        if not recorded or position >= len(recorded):
+            self.misses += 1
+            raise CassetteMissError(key)
+        self._position[key] = position + 1
+        self.hits += 1
+        response, duration = recorded[position]
+        if self._latency and duration:
+            await asyncio.sleep(duration / self._speed)
+        return response
+
+    # pylint: disable=too-many-arguments,unused-argument
+    async def request(
+            self, session, method, url, params=None, data=None, headers=None):
+        """Replay the response recorded for the request"""
+        response = await self._replay(method, url, params, data)
+        return response, response.body
+
+    # pylint: disable=unused-argument
+    @contextlib.asynccontextmanager
+    async def stream(self, session, url, params=None, headers=None):
+        """Replay the response recorded for the streamed request"""
+        yield await self._replay('GET', url, params, None)
+
+    async def close(self):
+        """Nothing to release"""